@@ -54,6 +54,7 @@ from socket import socket, AF_UNIX, SOCK_STREAM
 from httplib import HTTP, HTTPConnection
 
 PLUGIN_TAP_PAUSE = "tapdisk-pause"
+PLUGIN_TASK_MAX_INFLIGHT = 8
 
 SOCKPATH = "/var/xapi/xcp-rrdd"
 
@@ -1375,6 +1376,101 @@ class VDI(object):
         session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
         return True
 
+    @classmethod
+    def tap_pause_many(cls, session, sr_uuid, vdi_uuids, failfast=False):
+        """
+        Pauses several tapdisks. The per-host tap-pause calls are issued as
+        asynchronous XAPI tasks, up to PLUGIN_TASK_MAX_INFLIGHT at a time, so
+        pausing N VDIs costs a few plugin round trips rather than N.
+
+        Returns the list of VDI UUIDs that were paused on every host. As
+        soon as one VDI fails to pause no further VDIs are submitted.
+        """
+        pending = []
+        failed = set()
+        submitted = []
+        for vdi_uuid in vdi_uuids:
+            pending = cls._wait_pluginhandler_tasks(session, pending, failed,
+                    PLUGIN_TASK_MAX_INFLIGHT - 1, stop_on_failure=True)
+            if failed:
+                break
+            util.SMlog("Pause request for %s" % vdi_uuid)
+            submitted.append(vdi_uuid)
+            try:
+                vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
+                session.xenapi.VDI.add_to_sm_config(vdi_ref, 'paused', 'true')
+                sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
+                for key in filter(lambda x: x.startswith('host_'),
+                        sm_config.keys()):
+                    host_ref = key[len('host_'):]
+                    util.SMlog("Calling tap-pause on host %s" % host_ref)
+                    task = cls._call_pluginhandler_async(session, host_ref,
+                            sr_uuid, vdi_uuid, "pause", failfast=failfast)
+                    if task is None:
+                        failed.add(vdi_uuid)
+                        break
+                    pending.append((vdi_uuid, task))
+            except Exception as e:
+                util.logException("BLKTAP2:tap_pause_many %s" % e)
+                failed.add(vdi_uuid)
+        cls._wait_pluginhandler_tasks(session, pending, failed)
+        paused = []
+        for vdi_uuid in submitted:
+            if vdi_uuid not in failed:
+                paused.append(vdi_uuid)
+                continue
+            # Failed to pause node
+            try:
+                vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
+                session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
+            except Exception as e:
+                util.logException("BLKTAP2:tap_pause_many %s" % e)
+        return paused
+
+    @classmethod
+    def tap_unpause_many(cls, session, sr_uuid, vdi_uuids):
+        """
+        Unpauses several tapdisks, overlapping the per-host tap-unpause
+        calls like tap_pause_many. Every VDI is attempted regardless of
+        failures; returns the list of VDI UUIDs that were unpaused on every
+        host.
+        """
+        pending = []
+        failed = set()
+        refs = {}
+        for vdi_uuid in vdi_uuids:
+            pending = cls._wait_pluginhandler_tasks(session, pending, failed,
+                    PLUGIN_TASK_MAX_INFLIGHT - 1)
+            util.SMlog("Unpause request for %s secondary=None" % vdi_uuid)
+            try:
+                refs[vdi_uuid] = session.xenapi.VDI.get_by_uuid(vdi_uuid)
+                sm_config = session.xenapi.VDI.get_sm_config(refs[vdi_uuid])
+                for key in filter(lambda x: x.startswith('host_'),
+                        sm_config.keys()):
+                    host_ref = key[len('host_'):]
+                    util.SMlog("Calling tap-unpause on host %s" % host_ref)
+                    task = cls._call_pluginhandler_async(session, host_ref,
+                            sr_uuid, vdi_uuid, "unpause")
+                    if task is None:
+                        failed.add(vdi_uuid)
+                        break
+                    pending.append((vdi_uuid, task))
+            except Exception as e:
+                util.logException("BLKTAP2:tap_unpause_many %s" % e)
+                failed.add(vdi_uuid)
+        cls._wait_pluginhandler_tasks(session, pending, failed)
+        unpaused = []
+        for vdi_uuid in vdi_uuids:
+            if vdi_uuid in failed:
+                continue
+            try:
+                session.xenapi.VDI.remove_from_sm_config(refs[vdi_uuid],
+                        'paused')
+                unpaused.append(vdi_uuid)
+            except Exception as e:
+                util.logException("BLKTAP2:tap_unpause_many %s" % e)
+        return unpaused
+
     @classmethod
     def tap_refresh(cls, session, sr_uuid, vdi_uuid, activate_parents = False):
         util.SMlog("Refresh request for %s" % vdi_uuid)
@@ -1419,6 +1515,40 @@ class VDI(object):
             util.logException("BLKTAP2:call_pluginhandler %s" % e)
             return False
 
+    @classmethod
+    def _call_pluginhandler_async(cls, session, host_ref, sr_uuid, vdi_uuid,
+            action, failfast=False):
+        """Like call_pluginhandler, but returns the XAPI task (or None if
+        the call could not be submitted) instead of waiting for it"""
+        try:
+            args = {"sr_uuid":sr_uuid, "vdi_uuid":vdi_uuid,
+                    "failfast": str(failfast)}
+            return util.call_plugin_async(session, host_ref,
+                    PLUGIN_TAP_PAUSE, action, args)
+        except Exception as e:
+            util.logException("BLKTAP2:_call_pluginhandler_async %s" % e)
+            return None
+
+    @classmethod
+    def _wait_pluginhandler_tasks(cls, session, pending, failed, max_left=0,
+            stop_on_failure=False):
+        """Wait for the (vdi_uuid, task) pairs in pending until no more than
+        max_left of them are still running (or, with stop_on_failure, until
+        any of them has failed). The VDIs whose task did not succeed are
+        added to failed. Returns the pairs still running"""
+        def failedTask(finished):
+            return any(result != "True" for _, result, _ in finished)
+        should_stop = None
+        if stop_on_failure:
+            should_stop = lambda finished: failed or failedTask(finished)
+        pending, finished = util.wait_plugin_tasks(session, pending,
+                max_left, should_stop)
+        for vdi_uuid, result, error in finished:
+            if result != "True":
+                util.SMlog("Plugin task for %s ended with %s" % \
+                        (vdi_uuid, error or result))
+                failed.add(vdi_uuid)
+        return pending
 
     def _add_tag(self, vdi_uuid, writable):
         util.SMlog("Adding tag to: %s" % vdi_uuid)
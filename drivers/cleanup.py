@@ -24,13 +24,15 @@ import os.path
 import sys
 import time
 import signal
+import select
 import subprocess
 import getopt
-import datetime
 import exceptions
 import traceback
 import base64
 import zlib
+import heapq
+import random
 import errno
 import stat
 
@@ -49,7 +51,7 @@ from refcounter import RefCounter
 from ipc import IPCFlag
 from lvmanager import LVActivator
 from srmetadata import LVMMetadataHandler
-from functools import reduce
+from bitarray import bitarray
 
 # Disable automatic leaf-coalescing. Online leaf-coalesce is currently not 
 # possible due to lvhd_stop_using_() not working correctly. However, we leave 
@@ -71,6 +73,9 @@ lockRunning = None
 LOCK_TYPE_GC_ACTIVE = "gc_active"
 lockActive = None
 
+# how often "disable" rechecks for the re-enable signal, in seconds
+SIGNAL_WAIT_POLL_INTERVAL = 1
+
 # Default coalesce error rate limit, in messages per minute. A zero value
 # disables throttling, and a negative value disables error reporting.
 DEFAULT_COALESCE_ERR_RATE = 1.0/60
@@ -96,6 +101,11 @@ class Util:
     RET_STDOUT = 2
     RET_STDERR = 4
 
+    # runAbortable child process results
+    RESULT_SUCCESS = "S"
+    RESULT_FAILURE = "F"
+    CHILD_EXIT_TIMEOUT = 20 # seconds
+
     UUID_LEN = 36
 
     PREFIX = {"G": 1024 * 1024 * 1024, "M": 1024 * 1024, "K": 1024}
@@ -104,12 +114,22 @@ class Util:
         util.SMlog(text, ident="SMGC")
     log = staticmethod(log)
 
+    def logf(fmt, *args):
+        """Like log(fmt % args), but skip the formatting altogether when
+        logging is turned off"""
+        if util.LOGGING:
+            Util.log(fmt % args)
+    logf = staticmethod(logf)
+
     def logException(tag):
         info = sys.exc_info()
         if info[0] == exceptions.SystemExit:
             # this should not be happening when catching "Exception", but it is
             sys.exit(0)
-        tb = reduce(lambda a, b: "%s%s" % (a, b), traceback.format_tb(info[2]))
+        if not util.LOGGING:
+            # nobody will see it, don't bother formatting the traceback
+            return
+        tb = "".join(traceback.format_tb(info[2]))
         Util.log("*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*")
         Util.log("         ***********************")
         Util.log("         *  E X C E P T I O N  *")
@@ -119,20 +139,23 @@ class Util:
         Util.log("*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*")
     logException = staticmethod(logException)
 
-    def doexec(args, expectedRC, inputtext=None, ret=None, log=True):
-        "Execute a subprocess, then return its return code, stdout, stderr"
+    def doexec(args, expectedRC, inputtext=None, ret=None, log=True,
+            shell=False):
+        """Execute a subprocess, then return its return code, stdout, stderr.
+        args is an argument list, or a command string if shell is set"""
         proc = subprocess.Popen(args,
                                 stdin=subprocess.PIPE,\
                                 stdout=subprocess.PIPE,\
                                 stderr=subprocess.PIPE,\
-                                shell=True,\
+                                shell=shell,\
                                 close_fds=True)
         (stdout, stderr) = proc.communicate(inputtext)
-        stdout = str(stdout)
-        stderr = str(stderr)
         rc = proc.returncode
         if log:
-            Util.log("`%s`: %s" % (args, rc))
+            cmd = args
+            if not shell:
+                cmd = " ".join(args)
+            Util.log("`%s`: %s" % (cmd, rc))
         if type(expectedRC) != type([]):
             expectedRC = [expectedRC]
         if not rc in expectedRC:
@@ -152,91 +175,115 @@ class Util:
     def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut):
         """execute func in a separate thread and kill it if abortTest signals
         so"""
-        abortSignaled = abortTest() # check now before we clear resultFlag
-        resultFlag = IPCFlag(ns)
-        resultFlag.clearAll()
+        # a pending abort request is consumed here: note it, then reset all
+        # the flags of namespace ns (the SR UUID, so including
+        # FLAG_TYPE_ABORT). The abort behaviour of the callers relies on this
+        # reset; the child's result is passed over a pipe, not these flags
+        abortSignaled = abortTest()
+        IPCFlag(ns).clearAll()
+        # the child reports its result over this pipe and holds the write end
+        # for its whole lifetime, so the read end also becomes readable (EOF)
+        # the moment it exits
+        exitFd, childFd = os.pipe()
         pid = os.fork()
         if pid:
+            os.close(childFd)
             startTime = time.time()
+            childExited = False
             try:
                 while True:
-                    if resultFlag.test("success"):
-                        Util.log("  Child process completed successfully")
-                        resultFlag.clear("success")
-                        return
-                    if resultFlag.test("failure"):
-                        resultFlag.clear("failure")
-                        raise util.SMException("Child process exited with error")
                     if abortTest() or abortSignaled:
                         os.killpg(pid, signal.SIGKILL)
                         raise AbortException("Aborting due to signal")
                     if timeOut and time.time() - startTime > timeOut:
                         os.killpg(pid, signal.SIGKILL)
-                        resultFlag.clearAll()
                         raise util.SMException("Timed out")
-                    time.sleep(pollInterval)
+                    ready = select.select([exitFd], [], [], pollInterval)[0]
+                    if not ready:
+                        continue
+                    result = os.read(exitFd, 1)
+                    if result == Util.RESULT_SUCCESS:
+                        Util.log("  Child process completed successfully")
+                        return
+                    if result == Util.RESULT_FAILURE:
+                        raise util.SMException("Child process exited with error")
+                    childExited = True
+                    raise util.SMException("Child process exited unexpectedly")
             finally:
-                wait_pid = 0
-                rc = -1
-                count = 0
-                while wait_pid == 0 and count < 10:
-                    wait_pid, rc = os.waitpid(pid, os.WNOHANG)
-                    if wait_pid == 0:
-                        time.sleep(2)
-                        count += 1
-
-                if wait_pid == 0:
+                # the child has either been killed or is about to exit after
+                # reporting its result: wait for the pipe to signal its exit
+                # and then reap it, instead of polling waitpid. The pipe may
+                # still hold the result byte (if the child reported just as
+                # we aborted or timed out), so read on until EOF
+                deadline = time.time() + Util.CHILD_EXIT_TIMEOUT
+                while not childExited:
+                    left = deadline - time.time()
+                    if left <= 0 or not select.select([exitFd], [], [],
+                            left)[0]:
+                        break
+                    childExited = not os.read(exitFd, 1)
+                os.close(exitFd)
+                if childExited:
+                    os.waitpid(pid, 0)
+                elif os.waitpid(pid, os.WNOHANG)[0] == 0:
                     Util.log("runAbortable: wait for process completion timed out")
         else:
+            os.close(exitFd)
             os.setpgrp()
+            result = Util.RESULT_FAILURE
             try:
                 if func() == ret:
-                    resultFlag.set("success")
-                else:
-                    resultFlag.set("failure")
+                    result = Util.RESULT_SUCCESS
             except Exception as e:
                 Util.log("Child process failed with : (%s)" % e)
-                resultFlag.set("failure")
                 Util.logException("This exception has occured")
+            os.write(childFd, result)
             os._exit(0)
     runAbortable = staticmethod(runAbortable)
 
+    def abortableSleep(seconds, abortTest, pollInterval):
+        """Sleep for the given number of seconds, but raise AbortException
+        as soon as abortTest (checked every pollInterval) signals so"""
+        deadline = time.time() + seconds
+        while True:
+            if abortTest():
+                raise AbortException("Aborting due to signal")
+            left = deadline - time.time()
+            if left <= 0:
+                return
+            time.sleep(min(pollInterval, left))
+    abortableSleep = staticmethod(abortableSleep)
+
     def num2str(number):
-        for prefix in ("G", "M", "K"):
-            if number >= Util.PREFIX[prefix]:
-                return "%.3f%s" % (float(number) / Util.PREFIX[prefix], prefix)
-        return "%s" % number
+        # bit_length() - 1 is floor(log2(number)), which picks the unit
+        exp = min((int(number).bit_length() - 1) // 10, 3)
+        if number <= 0 or exp <= 0:
+            return "%s" % number
+        prefix = "KMG"[exp - 1]
+        return "%.3f%s" % (float(number) / Util.PREFIX[prefix], prefix)
     num2str = staticmethod(num2str)
 
-    def numBits(val):
-        count = 0
-        while val:
-            count += val & 1
-            val = val >> 1
-        return count
+    if hasattr(int, "bit_count"):
+        def numBits(val):
+            return val.bit_count()
+    else:
+        def numBits(val):
+            return bin(val).count("1")
     numBits = staticmethod(numBits)
 
     def countBits(bitmap1, bitmap2):
         """return bit count in the bitmap produced by ORing the two bitmaps"""
         len1 = len(bitmap1)
         len2 = len(bitmap2)
-        lenLong = len1
-        lenShort = len2
-        bitmapLong = bitmap1
-        if len2 > len1:
-            lenLong = len2
-            lenShort = len1
-            bitmapLong = bitmap2
-
-        count = 0
-        for i in range(lenShort):
-            val = ord(bitmap1[i]) | ord(bitmap2[i])
-            count += Util.numBits(val)
-
-        for i in range(i + 1, lenLong):
-            val = ord(bitmapLong[i])
-            count += Util.numBits(val)
-        return count
+        lenLong = max(len1, len2)
+        # pad the shorter bitmap at the end so that the bytes line up, then
+        # let bitarray do the OR and the popcount in C
+        bits1 = bitarray()
+        bits1.frombytes(bitmap1 + "\0" * (lenLong - len1))
+        bits2 = bitarray()
+        bits2.frombytes(bitmap2 + "\0" * (lenLong - len2))
+        bits1 |= bits2
+        return bits1.count(1)
     countBits = staticmethod(countBits)
 
     def getThisScript():
@@ -254,6 +301,7 @@ class Util:
 class XAPI:
     USER = "root"
     PLUGIN_ON_SLAVE = "on-slave"
+    HOST_RECORDS_TTL = 60 # seconds
 
     CONFIG_SM = 0
     CONFIG_OTHER = 1
@@ -282,14 +330,18 @@ class XAPI:
         if self.session == None:
             self.session = self.getSession()
             self.sessionPrivate = True
-        self._srRef = self.session.xenapi.SR.get_by_uuid(srUuid)
-        self.srRecord = self.session.xenapi.SR.get_record(self._srRef)
+        self.xenapi = self.session.xenapi
+        self._srRef = self.xenapi.SR.get_by_uuid(srUuid)
+        self.srRecord = self.xenapi.SR.get_record(self._srRef)
         self.hostUuid = util.get_this_host()
-        self._hostRef = self.session.xenapi.host.get_by_uuid(self.hostUuid)
+        self._hostRef = self.xenapi.host.get_by_uuid(self.hostUuid)
+        self._vdiRefCache = {}
+        self._hostRecords = (None, {})
+        self._coalesceErrRate = None
 
     def __del__(self):
         if self.sessionPrivate:
-            self.session.xenapi.session.logout()
+            self.xenapi.session.logout()
 
     def isPluggedHere(self):
         pbds = self.getAttachedPBDs()
@@ -299,17 +351,17 @@ class XAPI:
         return False
 
     def poolOK(self):
-        host_recs = self.session.xenapi.host.get_all_records()
-        for host_ref, host_rec in host_recs.iteritems():
-            if not host_rec["enabled"]:
-                Util.log("Host %s not enabled" % host_rec["uuid"])
-                return False
-        return True
+        host_recs = self.xenapi.host.get_all_records_where( \
+                'field "enabled" = "false"')
+        for host_rec in host_recs.itervalues():
+            Util.log("Host %s not enabled" % host_rec["uuid"])
+        return not host_recs
 
     def isMaster(self):
         if self.srRecord["shared"]:
-            pool = self.session.xenapi.pool.get_all_records().values()[0]
-            return pool["master"] == self._hostRef
+            pools = self.xenapi.pool.get_all()
+            master = self.xenapi.pool.get_master(pools[0])
+            return master == self._hostRef
         else:
             pbds = self.getAttachedPBDs()
             if len(pbds) < 1:
@@ -321,26 +373,75 @@ class XAPI:
     def getAttachedPBDs(self):
         """Return PBD records for all PBDs of this SR that are currently
         attached"""
-        attachedPBDs = []
-        pbds = self.session.xenapi.PBD.get_all_records()
-        for pbdRec in pbds.values():
-            if pbdRec["SR"] == self._srRef and pbdRec["currently_attached"]:
-                attachedPBDs.append(pbdRec)
-        return attachedPBDs
+        pbds = self.xenapi.PBD.get_all_records_where( \
+                'field "SR" = "%s" and field "currently_attached" = "true"' % \
+                self._srRef)
+        return pbds.values()
+
+    def getCoalesceErrRate(self):
+        """Return the maximum rate of coalesce error messages (per minute) as
+        configured in the SR other-config when we started"""
+        if self._coalesceErrRate is None:
+            oth_cfg = self.srRecord.get("other_config", {})
+            if COALESCE_ERR_RATE_TAG in oth_cfg:
+                self._coalesceErrRate = float(oth_cfg[COALESCE_ERR_RATE_TAG])
+            else:
+                self._coalesceErrRate = DEFAULT_COALESCE_ERR_RATE
+        return self._coalesceErrRate
 
     def getOnlineHosts(self):
         return util.get_online_hosts(self.session)
 
-    def ensureInactive(self, hostRef, args):
-        text = self.session.xenapi.host.call_plugin( \
-                hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
-        Util.log("call-plugin returned: '%s'" % text)
+    def callPluginOnHosts(self, hostRefs, plugin, fn, args, abortFlag=None):
+        """Call plugin fn with args on all hostRefs at the same time, as
+        asynchronous XAPI tasks, and wait for all of them. Return a pair of
+        dicts: {hostRef: result} for the calls that succeeded and
+        {hostRef: XenAPI.Failure} for those that did not"""
+        results = {}
+        failures = {}
+        pending = []
+        for hostRef in hostRefs:
+            try:
+                pending.append((hostRef, util.call_plugin_async(self.session,
+                        hostRef, plugin, fn, args)))
+            except XenAPI.Failure as e:
+                failures[hostRef] = e
+
+        def checkAbort(finished):
+            if abortFlag and abortFlag.test(FLAG_TYPE_ABORT):
+                raise AbortException("Aborting due to signal")
+            return False
+
+        pending, finished = util.wait_plugin_tasks(self.session, pending,
+                should_stop=checkAbort)
+        for hostRef, result, error in finished:
+            if error is None:
+                results[hostRef] = result
+            else:
+                failures[hostRef] = error
+        return results, failures
 
     def getRecordHost(self, hostRef):
-        return self.session.xenapi.host.get_record(hostRef)
+        """Get the host record, from a copy of all the host records that is
+        refreshed every HOST_RECORDS_TTL seconds: the callers only want the
+        hostname, which hardly ever changes"""
+        fetched, records = self._hostRecords
+        now = time.time()
+        if fetched is None or not (0 <= now - fetched < self.HOST_RECORDS_TTL):
+            records = self.xenapi.host.get_all_records()
+            self._hostRecords = (now, records)
+        rec = records.get(hostRef)
+        if rec is None:
+            # a host that joined since the last refresh
+            rec = self.xenapi.host.get_record(hostRef)
+        return rec
 
     def _getRefVDI(self, uuid):
-        return self.session.xenapi.VDI.get_by_uuid(uuid)
+        ref = self._vdiRefCache.get(uuid)
+        if ref is None:
+            ref = self.xenapi.VDI.get_by_uuid(uuid)
+            self._vdiRefCache[uuid] = ref
+        return ref
 
     def getRefVDI(self, vdi):
         return self._getRefVDI(vdi.uuid)
@@ -348,33 +449,44 @@ class XAPI:
     def getRecordVDI(self, uuid):
         try:
             ref = self._getRefVDI(uuid)
-            return self.session.xenapi.VDI.get_record(ref)
+            return self.xenapi.VDI.get_record(ref)
         except XenAPI.Failure:
+            self._vdiRefCache.pop(uuid, None)
             return None
 
+    def getAllRecordsVDI(self):
+        """Get the records of all VDIs in the pool with a single call, as a
+        dict keyed on VDI uuid"""
+        records = {}
+        for ref, rec in self.xenapi.VDI.get_all_records().iteritems():
+            self._vdiRefCache[rec["uuid"]] = ref
+            records[rec["uuid"]] = rec
+        return records
+
     def singleSnapshotVDI(self, vdi):
-        return self.session.xenapi.VDI.snapshot(vdi.getRef(),
+        return self.xenapi.VDI.snapshot(vdi.getRef(),
                 {"type":"internal"})
 
     def forgetVDI(self, srUuid, vdiUuid):
         """Forget the VDI, but handle the case where the VDI has already been
         forgotten (i.e. ignore errors)"""
         try:
-            vdiRef = self.session.xenapi.VDI.get_by_uuid(vdiUuid)
-            self.session.xenapi.VDI.forget(vdiRef)
+            vdiRef = self._getRefVDI(vdiUuid)
+            self.xenapi.VDI.forget(vdiRef)
         except XenAPI.Failure:
             pass
+        self._vdiRefCache.pop(vdiUuid, None)
 
     def getConfigVDI(self, vdi, key):
         kind = vdi.CONFIG_TYPE[key]
         if kind == self.CONFIG_SM:
-            cfg = self.session.xenapi.VDI.get_sm_config(vdi.getRef())
+            cfg = self.xenapi.VDI.get_sm_config(vdi.getRef())
         elif kind == self.CONFIG_OTHER:
-            cfg = self.session.xenapi.VDI.get_other_config(vdi.getRef())
+            cfg = self.xenapi.VDI.get_other_config(vdi.getRef())
         elif kind == self.CONFIG_ON_BOOT:
-            cfg = self.session.xenapi.VDI.get_on_boot(vdi.getRef())
+            cfg = self.xenapi.VDI.get_on_boot(vdi.getRef())
         elif kind == self.CONFIG_ALLOW_CACHING:
-            cfg = self.session.xenapi.VDI.get_allow_caching(vdi.getRef())
+            cfg = self.xenapi.VDI.get_allow_caching(vdi.getRef())
         else:
             assert(False)
         Util.log("Got %s for %s: %s" % (self.CONFIG_NAME[kind], vdi, repr(cfg)))
@@ -383,26 +495,26 @@ class XAPI:
     def removeFromConfigVDI(self, vdi, key):
         kind = vdi.CONFIG_TYPE[key]
         if kind == self.CONFIG_SM:
-            self.session.xenapi.VDI.remove_from_sm_config(vdi.getRef(), key)
+            self.xenapi.VDI.remove_from_sm_config(vdi.getRef(), key)
         elif kind == self.CONFIG_OTHER:
-            self.session.xenapi.VDI.remove_from_other_config(vdi.getRef(), key)
+            self.xenapi.VDI.remove_from_other_config(vdi.getRef(), key)
         else:
             assert(False)
 
     def addToConfigVDI(self, vdi, key, val):
         kind = vdi.CONFIG_TYPE[key]
         if kind == self.CONFIG_SM:
-            self.session.xenapi.VDI.add_to_sm_config(vdi.getRef(), key, val)
+            self.xenapi.VDI.add_to_sm_config(vdi.getRef(), key, val)
         elif kind == self.CONFIG_OTHER:
-            self.session.xenapi.VDI.add_to_other_config(vdi.getRef(), key, val)
+            self.xenapi.VDI.add_to_other_config(vdi.getRef(), key, val)
         else:
             assert(False)
 
     def isSnapshot(self, vdi):
-        return self.session.xenapi.VDI.get_is_a_snapshot(vdi.getRef())
+        return self.xenapi.VDI.get_is_a_snapshot(vdi.getRef())
 
     def markCacheSRsDirty(self):
-        sr_refs = self.session.xenapi.SR.get_all_records_where( \
+        sr_refs = self.xenapi.SR.get_all_records_where( \
                 'field "local_cache_enabled" = "true"')
         for sr_ref in sr_refs:
             Util.log("Marking SR %s dirty" % sr_ref)
@@ -411,11 +523,11 @@ class XAPI:
     def srUpdate(self):
         Util.log("Starting asynch srUpdate for SR %s" % self.srRecord["uuid"])
         abortFlag = IPCFlag(self.srRecord["uuid"])
-        task = self.session.xenapi.Async.SR.update(self._srRef)
+        task = self.xenapi.Async.SR.update(self._srRef)
         cancelTask = True
         try:
             for i in range(60):
-                status = self.session.xenapi.task.get_status(task)
+                status = self.xenapi.task.get_status(task)
                 if not status == "pending":
                     Util.log("SR.update_asynch status changed to [%s]" % status)
                     cancelTask = False
@@ -423,7 +535,7 @@ class XAPI:
                 if abortFlag.test(FLAG_TYPE_ABORT):
                     Util.log("Abort signalled during srUpdate, cancelling task...")
                     try:
-                        self.session.xenapi.task.cancel(task)
+                        self.xenapi.task.cancel(task)
                         cancelTask = False
                         Util.log("Task cancelled")
                     except:
@@ -432,8 +544,8 @@ class XAPI:
                 time.sleep(1)
         finally:
             if cancelTask:
-                self.session.xenapi.task.cancel(task)
-            self.session.xenapi.task.destroy(task)
+                self.xenapi.task.cancel(task)
+            self.xenapi.task.destroy(task)
         Util.log("Asynch srUpdate still running, but timeout exceeded.")
 
 
@@ -507,6 +619,13 @@ class VDI:
         self.parent     = None
         self.children   = []
         self._vdiRef    = None
+        self._heightCache = (None, None)
+        self._rootCache = (None, None)
+        self._leavesCache = (None, None)
+        self._blockBitmapCache = (None, None)
+        self._combinedBlocksCache = (None, None, None)
+        self._overheadEmptyCache = (None, None)
+        self._extraSpaceCache = (None, None)
         self._clearRef()
 
     def load(self):
@@ -527,6 +646,10 @@ class VDI:
             val = config
         else:
             val = config.get(key)
+        if key == self.DB_VHD_BLOCKS:
+            # keep track of what xapi really has so that updateBlockInfo
+            # does not skip re-adding block info that was removed
+            self._blockInfoSet = val
         if val:
             return val
         return default
@@ -538,6 +661,8 @@ class VDI:
 
     def delConfig(self, key):
         self.sr.xapi.removeFromConfigVDI(self, key)
+        if key == VDI.DB_VHD_BLOCKS:
+            self._blockInfoSet = None
         Util.log("Removed %s from %s" % (key, self))
 
     def ensureUnpaused(self):
@@ -552,8 +677,7 @@ class VDI:
 
     def _report_tapdisk_unpause_error(self):
         try:
-            xapi = self.sr.xapi.session.xenapi
-            sr_ref = xapi.SR.get_by_uuid(self.sr.uuid)
+            xapi = self.sr.xapi.xenapi
             msg_name = "failed to unpause tapdisk"
             msg_body = "Failed to unpause tapdisk for VDI %s, " \
                     "VMs using this tapdisk have lost access " \
@@ -590,28 +714,33 @@ class VDI:
 
     def isAttachedRW(self):
         return util.is_attached_rw(
-                self.sr.xapi.session.xenapi.VDI.get_sm_config(self.getRef()))
+                self.sr.xapi.xenapi.VDI.get_sm_config(self.getRef()))
 
     def getVHDBlocks(self):
         val = self.updateBlockInfo()
-        bitmap = zlib.decompress(base64.b64decode(val))
-        return bitmap
+        if self._blockBitmapCache[0] != val:
+            bitmap = zlib.decompress(base64.b64decode(val))
+            self._blockBitmapCache = (val, bitmap)
+        return self._blockBitmapCache[1]
 
     def isCoalesceable(self):
         """A VDI is coalesceable if it has no siblings and is not a leaf"""
-        return not self.scanError and \
-                self.parent and \
-                len(self.parent.children) == 1 and \
+        # roots and leaves are the common case: rule them out first
+        parent = self.parent
+        return parent is not None and \
+                len(self.children) > 0 and \
                 self.hidden and \
-                len(self.children) > 0 
+                len(parent.children) == 1 and \
+                not self.scanError
 
     def isLeafCoalesceable(self):
         """A VDI is leaf-coalesceable if it has no siblings and is a leaf"""
-        return not self.scanError and \
-                self.parent and \
-                len(self.parent.children) == 1 and \
+        parent = self.parent
+        return parent is not None and \
+                len(self.children) == 0 and \
                 not self.hidden and \
-                len(self.children) == 0
+                len(parent.children) == 1 and \
+                not self.scanError
 
     def canLiveCoalesce(self, speed):
         """Can we stop-and-leaf-coalesce this VDI? The VDI must be
@@ -630,65 +759,104 @@ class VDI:
                 self.getConfig(self.DB_LEAFCLSC) == self.LEAFCLSC_FORCE)
 
     def getAllPrunable(self):
-        if len(self.children) == 0: # base case
-            # it is possible to have a hidden leaf that was recently coalesced 
-            # onto its parent, its children already relinked but not yet 
-            # reloaded - in which case it may not be garbage collected yet: 
-            # some tapdisks could still be using the file.
-            if self.sr.journaler.get(self.JRN_RELINK, self.uuid):
-                return []
-            if not self.scanError and self.hidden:
-                return [self]
-            return []
-
-        thisPrunable = True
-        vdiList = []
-        for child in self.children:
-            childList = child.getAllPrunable()
-            vdiList.extend(childList)
-            if child not in childList:
-                thisPrunable = False
+        # post-order walk with an explicit stack: a node is prunable if all
+        # its children are, so children are resolved before their parent
+        prunable = {}
+        stack = [(self, False)]
+        while stack:
+            vdi, expanded = stack.pop()
+            if len(vdi.children) > 0 and not expanded:
+                stack.append((vdi, True))
+                stack.extend([(child, False) for child in reversed(vdi.children)])
+                continue
 
-        if not self.scanError and thisPrunable:
-            vdiList.append(self)
-        return vdiList
+            vdiList = []
+            if len(vdi.children) == 0:
+                # it is possible to have a hidden leaf that was recently
+                # coalesced onto its parent, its children already relinked but
+                # not yet reloaded - in which case it may not be garbage
+                # collected yet: some tapdisks could still be using the file.
+                if not self.sr.journaler.get(self.JRN_RELINK, vdi.uuid) and \
+                        not vdi.scanError and vdi.hidden:
+                    vdiList.append(vdi)
+            else:
+                thisPrunable = True
+                for child in vdi.children:
+                    childList = prunable.pop(child)
+                    vdiList.extend(childList)
+                    # a prunable child is always the last entry of its list
+                    if not childList or childList[-1] is not child:
+                        thisPrunable = False
+                if not vdi.scanError and thisPrunable:
+                    vdiList.append(vdi)
+            prunable[vdi] = vdiList
+        return prunable[self]
 
     def getSizeVHD(self):
         return self._sizeVHD
 
     def getTreeRoot(self):
         "Get the root of the tree that self belongs to"
-        root = self
-        while root.parent:
-            root = root.parent
-        return root
+        epoch = self.sr._scanEpoch
+        if self._rootCache[0] != epoch:
+            # stop at the first ancestor that already knows its root, and
+            # remember the answer for everything on the way up
+            path = []
+            root = self
+            while root.parent and root._rootCache[0] != epoch:
+                path.append(root)
+                root = root.parent
+            if root._rootCache[0] == epoch:
+                root = root._rootCache[1]
+            else:
+                path.append(root)
+            for vdi in path:
+                vdi._rootCache = (epoch, root)
+        return self._rootCache[1]
         
     def getTreeHeight(self):
         "Get the height of the subtree rooted at self"
-        if len(self.children) == 0:
-            return 1
-
-        maxChildHeight = 0
-        for child in self.children:
-            childHeight = child.getTreeHeight()
-            if childHeight > maxChildHeight:
-                maxChildHeight = childHeight
-
-        return maxChildHeight + 1
+        epoch = self.sr._scanEpoch
+        if self._heightCache[0] != epoch:
+            # post-order walk, caching the height of every node on the way so
+            # that subtrees are not walked again until the tree changes
+            stack = [(self, False)]
+            while stack:
+                vdi, expanded = stack.pop()
+                if vdi._heightCache[0] == epoch:
+                    continue
+                if not expanded:
+                    stack.append((vdi, True))
+                    stack.extend([(child, False) for child in vdi.children])
+                    continue
+                height = 1
+                for child in vdi.children:
+                    height = max(height, child._heightCache[1] + 1)
+                vdi._heightCache = (epoch, height)
+        return self._heightCache[1]
 
     def getAllLeaves(self):
         "Get all leaf nodes in the subtree rooted at self"
-        if len(self.children) == 0:
-            return [self]
-
-        leaves = []
-        for child in self.children:
-            leaves.extend(child.getAllLeaves())
-        return leaves
+        epoch = self.sr._scanEpoch
+        if self._leavesCache[0] != epoch:
+            self._leavesCache = (epoch, tuple(self._iterLeaves()))
+        return list(self._leavesCache[1])
+
+    def _iterLeaves(self):
+        "Iterate over the leaf nodes in the subtree rooted at self"
+        stack = [self]
+        while stack:
+            vdi = stack.pop()
+            if len(vdi.children) == 0:
+                yield vdi
+            else:
+                stack.extend(reversed(vdi.children))
 
     def updateBlockInfo(self):
         val = base64.b64encode(self._queryVHDBlocks())
-        self.setConfig(VDI.DB_VHD_BLOCKS, val)
+        if val != self._blockInfoSet:
+            self.setConfig(VDI.DB_VHD_BLOCKS, val)
+            self._blockInfoSet = val
         return val
 
     def rename(self, uuid):
@@ -698,6 +866,7 @@ class VDI:
         oldUuid = self.uuid
         self.uuid = uuid
         self.children = []
+        self.sr._treeChanged(self)
         # updating the children themselves is the responsiblity of the caller
         del self.sr.vdis[oldUuid]
         self.sr.vdis[self.uuid] = self
@@ -739,12 +908,15 @@ class VDI:
 
     def _clearRef(self):
         self._vdiRef = None
+        # the block info last stored belongs to the old VDI record
+        self._blockInfoSet = None
 
     def _doCoalesce(self):
         """Coalesce self onto parent. Only perform the actual coalescing of
         VHD, but not the subsequent relinking. We'll do that as the next step,
         after reloading the entire SR in case things have changed while we
         were coalescing"""
+        self._extraSpaceCache = (None, None)
         self.validate()
         self.parent.validate(True)
         self.parent._increaseSizeVirt(self.sizeVirt)
@@ -756,16 +928,16 @@ class VDI:
 
     def _verifyContents(self, timeOut):
         Util.log("  Coalesce verification on %s" % self)
-        abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
+        abortTest = lambda:self.sr.abortFlag.test(FLAG_TYPE_ABORT)
         Util.runAbortable(lambda: self._runTapdiskDiff(), True,
                 self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
         Util.log("  Coalesce verification succeeded")
 
     def _runTapdiskDiff(self):
-        cmd = "tapdisk-diff -n %s:%s -m %s:%s" % \
-                (self.getDriverName(), self.path, \
-                self.parent.getDriverName(), self.parent.path)
-        Util.doexec(cmd, 0)
+        args = ["tapdisk-diff",
+                "-n", "%s:%s" % (self.getDriverName(), self.path),
+                "-m", "%s:%s" % (self.parent.getDriverName(), self.parent.path)]
+        Util.doexec(args, 0)
         return True
 
     def _reportCoalesceError(vdi, ce):
@@ -789,26 +961,21 @@ class VDI:
                 % (vdi.sr.uuid, msg_name, msg_body))
 
         # Create a XenCenter message, but don't spam.
-        xapi = vdi.sr.xapi.session.xenapi
-        sr_ref = xapi.SR.get_by_uuid(vdi.sr.uuid)
-        oth_cfg = xapi.SR.get_other_config(sr_ref)
-        if COALESCE_ERR_RATE_TAG in oth_cfg:
-            coalesce_err_rate = float(oth_cfg[COALESCE_ERR_RATE_TAG])
-        else:
-            coalesce_err_rate = DEFAULT_COALESCE_ERR_RATE
+        xapi = vdi.sr.xapi.xenapi
+        sr_ref = vdi.sr.xapi._srRef
+        coalesce_err_rate = vdi.sr.xapi.getCoalesceErrRate()
 
         xcmsg = False
         if coalesce_err_rate == 0:
             xcmsg = True
         elif coalesce_err_rate > 0:
-            now = datetime.datetime.now()
+            now = time.time()
             sm_cfg = xapi.SR.get_sm_config(sr_ref)
             if COALESCE_LAST_ERR_TAG in sm_cfg:
                 # seconds per message (minimum distance in time between two
                 # messages in seconds)
-                spm = datetime.timedelta(seconds=(1.0/coalesce_err_rate)*60)
-                last = datetime.datetime.fromtimestamp(
-                        float(sm_cfg[COALESCE_LAST_ERR_TAG]))
+                spm = (1.0/coalesce_err_rate)*60
+                last = float(sm_cfg[COALESCE_LAST_ERR_TAG])
                 if now - last >= spm:
                     xapi.SR.remove_from_sm_config(sr_ref,
                             COALESCE_LAST_ERR_TAG)
@@ -817,7 +984,7 @@ class VDI:
                 xcmsg = True
             if xcmsg:
                 xapi.SR.add_to_sm_config(sr_ref, COALESCE_LAST_ERR_TAG,
-                        str(now.strftime('%s')))
+                        str(int(now)))
         if xcmsg:
             xapi.message.create(msg_name, "3", "SR", vdi.sr.uuid, msg_body)
     _reportCoalesceError = staticmethod(_reportCoalesceError)
@@ -846,7 +1013,7 @@ class VDI:
 
     def _coalesceVHD(self, timeOut):
         Util.log("  Running VHD coalesce on %s" % self)
-        abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
+        abortTest = lambda:self.sr.abortFlag.test(FLAG_TYPE_ABORT)
         try:
             Util.runAbortable(lambda: VDI._doCoalesceVHD(self), None,
                     self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
@@ -866,12 +1033,16 @@ class VDI:
                            'after failed coalesce on %s, err: %s' % 
                            (parent, self.path, e))
             raise
+        finally:
+            # the coalesce ran in a child process, which may have added a
+            # sample to the speed log behind our back
+            self.sr._forgetStorageSpeed()
 
         util.fistpoint.activate("LVHDRT_coalescing_VHD_data",self.sr.uuid)
 
     def _relinkSkip(self):
         """Relink children of this VDI to point to the parent of this VDI"""
-        abortFlag = IPCFlag(self.sr.uuid)
+        abortFlag = self.sr.abortFlag
         for child in self.children:
             if abortFlag.test(FLAG_TYPE_ABORT):
                 raise AbortException("Aborting due to signal")
@@ -880,11 +1051,12 @@ class VDI:
             util.fistpoint.activate("LVHDRT_relinking_grandchildren",self.sr.uuid)
             child._setParent(self.parent)
         self.children = []
+        self.sr._treeChanged(self)
 
     def _reloadChildren(self, vdiSkip):
         """Pause & unpause all VDIs in the subtree to cause blktap to reload
         the VHD metadata for this file in any online VDI"""
-        abortFlag = IPCFlag(self.sr.uuid)
+        abortFlag = self.sr.abortFlag
         for child in self.children:
             if child == vdiSkip:
                 continue
@@ -895,45 +1067,47 @@ class VDI:
 
     def _reload(self):
         """Pause & unpause to cause blktap to reload the VHD metadata"""
-        for child in self.children:
-            child._reload()
-
         # only leaves can be attached
-        if len(self.children) == 0:
+        for leaf in self._iterLeaves():
             try:
-                self.delConfig(VDI.DB_VDI_RELINKING)
+                leaf.delConfig(VDI.DB_VDI_RELINKING)
             except XenAPI.Failure as e:
                 if not util.isInvalidVDI(e):
                     raise
-            self.refresh()
+            leaf.refresh()
 
     def _tagChildrenForRelink(self):
-        if len(self.children) == 0:
-            retries = 0
-            try:
-                while retries < 10:
-                    retries += 1
-                    if self.getConfig(VDI.DB_VDI_ACTIVATING) is not None:
-                        Util.log("VDI %s is activating, wait to relink" %
+        # only leaves can be attached
+        for leaf in self._iterLeaves():
+            leaf._tagForRelink()
+
+    def _tagForRelink(self):
+        # activations are usually short: poll quickly at first, then back
+        # off to once a second, giving up after about 10 seconds
+        waited = 0
+        delay = 0.1
+        try:
+            while waited < 10:
+                if self.getConfig(VDI.DB_VDI_ACTIVATING) is not None:
+                    Util.log("VDI %s is activating, wait to relink" %
+                             self.uuid)
+                else:
+                    self.setConfig(VDI.DB_VDI_RELINKING, "True")
+
+                    if self.getConfig(VDI.DB_VDI_ACTIVATING):
+                        self.delConfig(VDI.DB_VDI_RELINKING)
+                        Util.log("VDI %s started activating while tagging" %
                                  self.uuid)
                     else:
-                        self.setConfig(VDI.DB_VDI_RELINKING, "True")
-
-                        if self.getConfig(VDI.DB_VDI_ACTIVATING):
-                            self.delConfig(VDI.DB_VDI_RELINKING)
-                            Util.log("VDI %s started activating while tagging" %
-                                     self.uuid)
-                        else:
-                            return
-                    time.sleep(1)
-
-                raise util.SMException("Failed to tag vdi %s for relink" % self)
-            except XenAPI.Failure as e:
-                if not util.isInvalidVDI(e):
-                    raise
+                        return
+                time.sleep(delay)
+                waited += delay
+                delay = min(delay * 2, 1)
 
-        for child in self.children:
-            child._tagChildrenForRelink()
+            raise util.SMException("Failed to tag vdi %s for relink" % self)
+        except XenAPI.Failure as e:
+            if not util.isInvalidVDI(e):
+                raise
 
     def _loadInfoParent(self):
         ret = vhdutil.getParent(self.path, lvhdutil.extractUuid)
@@ -945,6 +1119,7 @@ class VDI:
         self.parent = parent
         self.parentUuid = parent.uuid
         parent.children.append(self)
+        self.sr._treeChanged(self)
         try:
             self.setConfig(self.DB_VHD_PARENT, self.parentUuid)
             Util.log("Updated the vhd-parent field for child %s with %s" % \
@@ -960,6 +1135,7 @@ class VDI:
     def _setHidden(self, hidden = True):
         vhdutil.setHidden(self.path, hidden)
         self.hidden = hidden
+        self.sr._treeChanged(self)
 
     def _increaseSizeVirt(self, size, atomic = True):
         """ensure the virtual size of 'self' is at least 'size'. Note that 
@@ -973,25 +1149,36 @@ class VDI:
         Util.log("  Expanding VHD virt size for VDI %s: %s -> %s" % \
                 (self, Util.num2str(self.sizeVirt), Util.num2str(size)))
 
-        msize = vhdutil.getMaxResizeSize(self.path) * 1024 * 1024
-        if (size <= msize):
-            vhdutil.setSizeVirtFast(self.path, size)
-        else:
-            if atomic:
-                vdiList = self._getAllSubtree()
-                self.sr.lock()
-                try:
-                    self.sr.pauseVDIs(vdiList)
+        try:
+            msize = vhdutil.getMaxResizeSize(self.path) * 1024 * 1024
+            if (size <= msize):
+                vhdutil.setSizeVirtFast(self.path, size)
+            else:
+                if atomic:
+                    vdiList = self._getAllSubtree()
+                    self.sr.lock()
                     try:
-                        self._setSizeVirt(size)
+                        self.sr.pauseVDIs(vdiList)
+                        try:
+                            self._setSizeVirt(size)
+                        finally:
+                            self.sr.unpauseVDIs(vdiList)
                     finally:
-                        self.sr.unpauseVDIs(vdiList)
-                finally:
-                    self.sr.unlock()
-            else:
-                self._setSizeVirt(size)
+                        self.sr.unlock()
+                else:
+                    self._setSizeVirt(size)
+        except Exception:
+            # we don't know how far the resize got: resync from the VHD, but
+            # don't let a failure to do so hide the original error
+            excInfo = sys.exc_info()
+            try:
+                self.sizeVirt = vhdutil.getSizeVirt(self.path)
+            except Exception:
+                Util.logException("_increaseSizeVirt resync")
+            raise excInfo[0], excInfo[1], excInfo[2]
 
-        self.sizeVirt = vhdutil.getSizeVirt(self.path)
+        # vhd-util resizes to whole MiB, just like the request it was given
+        self.sizeVirt = size / (1024 * 1024) * (1024 * 1024)
 
     def _setSizeVirt(self, size):
         """WARNING: do not call this method directly unless all VDIs in the
@@ -1013,36 +1200,64 @@ class VDI:
         self.delConfig(VDI.DB_VHD_BLOCKS)
         blocksChild = self.getVHDBlocks()
         blocksParent = self.parent.getVHDBlocks()
-        numBlocks = Util.countBits(blocksChild, blocksParent)
+        # the planning passes ask this repeatedly while neither bitmap moves:
+        # comparing the strings is much cheaper than OR-ing them again
+        cChild, cParent, numBlocks = self._combinedBlocksCache
+        if cChild != blocksChild or cParent != blocksParent:
+            numBlocks = Util.countBits(blocksChild, blocksParent)
+            self._combinedBlocksCache = (blocksChild, blocksParent, numBlocks)
         Util.log("Num combined blocks = %d" % numBlocks)
         sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
         assert(sizeData <= self.sizeVirt)
         return sizeData
 
+    def _getOverheadEmpty(self):
+        if self._overheadEmptyCache[0] != self.sizeVirt:
+            self._overheadEmptyCache = (self.sizeVirt,
+                    vhdutil.calcOverheadEmpty(self.sizeVirt))
+        return self._overheadEmptyCache[1]
+
     def _calcExtraSpaceForCoalescing(self):
         sizeData = self._getCoalescedSizeData()
         sizeCoalesced = sizeData + vhdutil.calcOverheadBitmap(sizeData) + \
-                vhdutil.calcOverheadEmpty(self.sizeVirt)
+                self._getOverheadEmpty()
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
         return sizeCoalesced - self.parent.getSizeVHD()
 
+    def _getExtraSpaceForCoalescing(self):
+        """_calcExtraSpaceForCoalescing(), remembered for the current scan
+        epoch: the candidate searches ask for it more than once per VDI"""
+        epoch = self.sr._scanEpoch
+        if self._extraSpaceCache[0] != epoch:
+            self._extraSpaceCache = (epoch,
+                    self._calcExtraSpaceForCoalescing())
+        return self._extraSpaceCache[1]
+
+    def _calcMaxExtraSpaceForCoalescing(self):
+        """Upper bound of _calcExtraSpaceForCoalescing() that does not need
+        the block bitmaps: the coalesced VHD is at most fully allocated"""
+        return vhdutil.fullSizeVHD(self.sizeVirt) - self.parent.getSizeVHD()
+
     def _calcExtraSpaceForLeafCoalescing(self):
         """How much extra space in the SR will be required to
         [live-]leaf-coalesce this VDI"""
         # the space requirements are the same as for inline coalesce
-        return self._calcExtraSpaceForCoalescing()
+        return self._getExtraSpaceForCoalescing()
 
     def _calcExtraSpaceForSnapshotCoalescing(self):
         """How much extra space in the SR will be required to
         snapshot-coalesce this VDI"""
-        return self._calcExtraSpaceForCoalescing() + \
-                vhdutil.calcOverheadEmpty(self.sizeVirt) # extra snap leaf
+        return self._getExtraSpaceForCoalescing() + \
+                self._getOverheadEmpty() # extra snap leaf
 
     def _getAllSubtree(self):
         """Get self and all VDIs in the subtree of self as a flat list"""
-        vdiList = [self]
-        for child in self.children:
-            vdiList.extend(child._getAllSubtree())
+        vdiList = []
+        stack = [self]
+        while stack:
+            vdi = stack.pop()
+            vdiList.append(vdi)
+            stack.extend(reversed(vdi.children))
         return vdiList
 
 
@@ -1241,6 +1456,7 @@ class LVHDVDI(VDI):
         if self.raw:
             self.sr.lvmCache.setHidden(self.fileName, hidden)
             self.hidden = hidden
+            self.sr._treeChanged(self)
         else:
             VDI._setHidden(self, hidden)
 
@@ -1271,14 +1487,14 @@ class LVHDVDI(VDI):
         """LVHD parents must first be activated, inflated, and made writable"""
         try:
             self._activateChain()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, False)
+            self.sr.lvmCache.apply(self.parent.fileName, readonly=False)
             self.parent.validate()
             self.inflateParentForCoalesce()
             VDI._doCoalesce(self)
         finally:
             self.parent._loadInfoSizeVHD()
             self.parent.deflate()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, True)
+            self.sr.lvmCache.apply(self.parent.fileName, readonly=True)
 
     def _setParent(self, parent):
         self._activate()
@@ -1294,6 +1510,7 @@ class LVHDVDI(VDI):
         self.parent = parent
         self.parentUuid = parent.uuid
         parent.children.append(self)
+        self.sr._treeChanged(self)
         try:
             self.setConfig(self.DB_VHD_PARENT, self.parentUuid)
             Util.log("Updated the vhd-parent field for child %s with %s" % \
@@ -1344,8 +1561,8 @@ class LVHDVDI(VDI):
             self.sr.journaler.create(self.JRN_ZERO, self.uuid, \
                     str(offset))
         Util.log("  Zeroing %s: from %d, %dB" % (self.path, offset, length))
-        abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
-        func = lambda: util.zeroOut(self.path, offset, length)
+        abortTest = lambda:self.sr.abortFlag.test(FLAG_TYPE_ABORT)
+        func = lambda: util.zeroRangeFast(self.path, offset, length)
         Util.runAbortable(func, True, self.sr.uuid, abortTest,
                 VDI.POLL_INTERVAL, 0)
         self.sr.journaler.remove(self.JRN_ZERO, self.uuid)
@@ -1374,15 +1591,20 @@ class LVHDVDI(VDI):
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
         return sizeCoalesced - self.parent.sizeLV
 
+    def _calcMaxExtraSpaceForCoalescing(self):
+        if self.parent.raw:
+            return 0
+        return lvhdutil.calcSizeVHDLV(self.sizeVirt) - self.parent.sizeLV
+
     def _calcExtraSpaceForLeafCoalescing(self):
         """How much extra space in the SR will be required to
         [live-]leaf-coalesce this VDI"""
         # we can deflate the leaf to minimize the space requirements
         deflateDiff = self.sizeLV - lvhdutil.calcSizeLV(self.getSizeVHD())
-        return self._calcExtraSpaceForCoalescing() - deflateDiff
+        return self._getExtraSpaceForCoalescing() - deflateDiff
 
     def _calcExtraSpaceForSnapshotCoalescing(self):
-        return self._calcExtraSpaceForCoalescing() + \
+        return self._getExtraSpaceForCoalescing() + \
                 lvhdutil.calcSizeLV(self.getSizeVHD())
 
 
@@ -1400,17 +1622,18 @@ class SR:
             self.currState = {}
 
         def logState(self):
-            changes = ""
+            changes = []
             self.currState.clear()
             for vdi in self.sr.vdiTrees:
                 self.currState[vdi.uuid] = self._getTreeStr(vdi)
                 if not self.prevState.get(vdi.uuid) or \
                         self.prevState[vdi.uuid] != self.currState[vdi.uuid]:
-                    changes += self.currState[vdi.uuid]
+                    changes.append(self.currState[vdi.uuid])
 
             for uuid in self.prevState.iterkeys():
                 if not self.currState.get(uuid):
-                    changes += "Tree %s gone\n" % uuid
+                    changes.append("Tree %s gone\n" % uuid)
+            changes = "".join(changes)
 
             result = "SR %s (%d VDIs in %d VHD trees): " % \
                     (self.sr, len(self.sr.vdis), len(self.sr.vdiTrees))
@@ -1424,9 +1647,7 @@ class SR:
 
             for line in result.split("\n"):
                 Util.log("%s" % line)
-            self.prevState.clear()
-            for key, val in self.currState.iteritems():
-                self.prevState[key] = val
+            self.prevState = dict(self.currState)
             self.stateLogged = True
 
         def logNewVDI(self, uuid):
@@ -1434,10 +1655,14 @@ class SR:
                 Util.log("Found new VDI when scanning: %s" % uuid)
 
         def _getTreeStr(self, vdi, indent = 8):
-            treeStr = "%s%s\n" % (" " * indent, vdi)
-            for child in vdi.children:
-                treeStr += self._getTreeStr(child, indent + VDI.STR_TREE_INDENT)
-            return treeStr
+            lines = []
+            stack = [(vdi, indent)]
+            while stack:
+                vdi, indent = stack.pop()
+                lines.append("%s%s\n" % (" " * indent, vdi))
+                stack.extend([(child, indent + VDI.STR_TREE_INDENT)
+                        for child in reversed(vdi.children)])
+            return "".join(lines)
 
 
     TYPE_FILE = "file"
@@ -1449,6 +1674,9 @@ class SR:
     LOCK_RETRY_ATTEMPTS_LOCK = 100
 
     SCAN_RETRY_ATTEMPTS = 3
+    SCAN_RETRY_BASE_SLEEP = 0.05 # seconds, doubled on every retry
+    SCAN_RETRY_MAX_SLEEP = 1
+    SCAN_FRESH_INTERVAL = 1 # seconds
 
     JRN_CLONE = "clone" # journal entry type for the clone operation (from SM)
     TMP_RENAME_PREFIX = "OLD_"
@@ -1473,8 +1701,13 @@ class SR:
         self.name = ""
         self.vdis = {}
         self.vdiTrees = []
+        self._vdiTreeSet = set()
+        self._dirtyRoots = set()
+        self._scanEpoch = 0
+        self._lastScan = (None, None)
         self.journaler = None
         self.xapi = xapi
+        self.abortFlag = IPCFlag(self.uuid)
         self._locked = 0
         self._srLock = None
         if createLock:
@@ -1482,7 +1715,9 @@ class SR:
         else:
             Util.log("Requested no SR locking")
         self.name = unicode(self.xapi.srRecord["name_label"]).encode("utf-8", "replace")
-        self._failedCoalesceTargets = []
+        self._failedCoalesceTargets = set()
+        self._categories = (None, None)
+        self._storageSpeed = (False, None)
 
         if not self.xapi.isPluggedHere():
             if force:
@@ -1497,8 +1732,10 @@ class SR:
 
     def gcEnabled(self, refresh = True):
         if refresh:
-            self.xapi.srRecord = \
-                    self.xapi.session.xenapi.SR.get_record(self.xapi._srRef)
+            # only other-config can change in a way we care about: don't
+            # fetch the whole record (which lists every VDI of the SR)
+            self.xapi.srRecord["other_config"] = \
+                    self.xapi.xenapi.SR.get_other_config(self.xapi._srRef)
         if self.xapi.srRecord["other_config"].get(VDI.DB_GC) == "false":
             Util.log("GC is disabled for this SR, abort")
             return False
@@ -1509,20 +1746,34 @@ class SR:
         update VDI objects if they already exist"""
         pass # abstract
 
-    def scanLocked(self, force = False):
+    def scanLocked(self, force = False, maxAge = 0):
+        """Scan the SR under the SR lock. With maxAge, skip the scan if the
+        last one done here is less than maxAge seconds old and nothing in the
+        tree has changed since"""
+        if maxAge and not force:
+            epoch, when = self._lastScan
+            if epoch == self._scanEpoch and 0 <= time.time() - when < maxAge:
+                Util.log("Last scan is still current, not rescanning")
+                return
         self.lock()
         try:
             self.scan(force)
+            self._lastScan = (self._scanEpoch, time.time())
         finally:
             self.unlock()
 
     def getVDI(self, uuid):
         return self.vdis.get(uuid)
 
+    def getVDIs(self, uuids):
+        """Get the VDIs among uuids that are present, as a {uuid: VDI} dict"""
+        vdis = self.vdis
+        return dict((uuid, vdis[uuid]) for uuid in uuids if uuid in vdis)
+
     def hasWork(self):
         if len(self.findGarbage()) > 0:
             return True
-        if self.findCoalesceable():
+        if self._hasCoalesceable():
             return True
         if self.findLeafCoalesceable():
             return True
@@ -1530,6 +1781,43 @@ class SR:
             return True
         return False
 
+    def _categorize(self):
+        """Sort the VDIs into (coalesceable, leaf-coalesceable, interior)
+        lists in one pass over self.vdis. Only the tree shape, the hidden
+        flags and scan errors are looked at, none of which change without a
+        scan epoch bump, so the lists are reused until the next bump"""
+        if self._categories[0] != self._scanEpoch:
+            coalesceable = []
+            leafCoalesceable = []
+            interior = []
+            for vdi in self.vdis.values():
+                if vdi.isCoalesceable():
+                    coalesceable.append(vdi)
+                elif vdi.isLeafCoalesceable():
+                    leafCoalesceable.append(vdi)
+                if not vdi.scanError and len(vdi.children) > 0:
+                    interior.append(vdi)
+            self._categories = (self._scanEpoch,
+                    (coalesceable, leafCoalesceable, interior))
+        return self._categories[1]
+
+    def _hasCoalesceable(self):
+        """Same answer as findCoalesceable() != None, but without querying the
+        block bitmaps whenever a candidate fits even when fully allocated"""
+        if self.getSwitch(VDI.DB_COALESCE) == "false":
+            return False
+        freeSpace = None
+        for vdi in self._categorize()[0]:
+            if vdi in self._failedCoalesceTargets:
+                continue
+            if freeSpace is None:
+                freeSpace = self.getFreeSpace()
+            if vdi._calcMaxExtraSpaceForCoalescing() <= freeSpace:
+                return True
+        if freeSpace is None and not self.journaler.getAll(VDI.JRN_RELINK):
+            return False
+        return self.findCoalesceable() is not None
+
     def findCoalesceable(self):
         """Find a coalesceable VDI. Return a vdi that should be coalesced
         (choosing one among all coalesceable candidates according to some
@@ -1549,32 +1837,27 @@ class SR:
             if vdi and vdi not in self._failedCoalesceTargets:
                 return vdi
 
-        for vdi in self.vdis.values():
-            if vdi.isCoalesceable() and vdi not in self._failedCoalesceTargets:
+        for vdi in self._categorize()[0]:
+            if vdi not in self._failedCoalesceTargets:
                 candidates.append(vdi)
-                Util.log("%s is coalescable" % vdi.uuid)
-
-        # pick one in the tallest tree
-        treeHeight = dict()
-        for c in candidates:
-            height = c.getTreeRoot().getTreeHeight()
-            if treeHeight.get(height):
-                treeHeight[height].append(c)
-            else:
-                treeHeight[height] = [c]
+                Util.logf("%s is coalescable", vdi.uuid)
+
+        # pick one in the tallest tree; the index keeps the scan order among
+        # candidates of the same height
+        heap = [(-c.getTreeRoot().getTreeHeight(), i, c) \
+                for i, c in enumerate(candidates)]
+        heapq.heapify(heap)
 
         freeSpace = self.getFreeSpace()
-        heights = treeHeight.keys()
-        heights.sort(reverse=True)
-        for h in heights:
-            for c in treeHeight[h]:
-                spaceNeeded = c._calcExtraSpaceForCoalescing()
-                if spaceNeeded <= freeSpace:
-                    Util.log("Coalesce candidate: %s (tree height %d)" % (c, h))
-                    return c
-                else:
-                    Util.log("No space to coalesce %s (free space: %d)" % \
-                            (c, freeSpace))
+        while heap:
+            h, i, c = heapq.heappop(heap)
+            spaceNeeded = c._getExtraSpaceForCoalescing()
+            if spaceNeeded <= freeSpace:
+                Util.logf("Coalesce candidate: %s (tree height %d)", c, -h)
+                return c
+            else:
+                Util.logf("No space to coalesce %s (free space: %d)",
+                        c, freeSpace)
         return None
 
     def getSwitch(self, key):
@@ -1616,15 +1899,15 @@ class SR:
             spaceNeededLive = spaceNeeded
             if spaceNeeded > freeSpace:
                 spaceNeededLive = candidate._calcExtraSpaceForLeafCoalescing()
-                if candidate.canLiveCoalesce(self.getStorageSpeed()):
+                if candidate.canLiveCoalesce(self._getStorageSpeedCached()):
                     spaceNeeded = spaceNeededLive
 
             if spaceNeeded <= freeSpace:
-                Util.log("Leaf-coalesce candidate: %s" % candidate)
+                Util.logf("Leaf-coalesce candidate: %s", candidate)
                 return candidate
             else:
-                Util.log("No space to leaf-coalesce %s (free space: %d)" % \
-                        (candidate, freeSpace))
+                Util.logf("No space to leaf-coalesce %s (free space: %d)",
+                        candidate, freeSpace)
                 if spaceNeededLive <= freeSpace:
                     Util.log("...but enough space if skip snap-coalesce")
                     candidate.setConfig(VDI.DB_LEAFCLSC, 
@@ -1633,19 +1916,17 @@ class SR:
         return None
 
     def gatherLeafCoalesceable(self, candidates):
-        for vdi in self.vdis.values():
-            if not vdi.isLeafCoalesceable():
-                continue
+        for vdi in self._categorize()[1]:
             if vdi in self._failedCoalesceTargets:
                 continue
             if vdi.getConfig(vdi.DB_ONBOOT) == vdi.ONBOOT_RESET:
-                Util.log("Skipping reset-on-boot %s" % vdi)
+                Util.logf("Skipping reset-on-boot %s", vdi)
                 continue
             if vdi.getConfig(vdi.DB_ALLOW_CACHING):
-                Util.log("Skipping allow_caching=true %s" % vdi)
+                Util.logf("Skipping allow_caching=true %s", vdi)
                 continue
             if vdi.getConfig(vdi.DB_LEAFCLSC) == vdi.LEAFCLSC_DISABLED:
-                Util.log("Leaf-coalesce disabled for %s" % vdi)
+                Util.logf("Leaf-coalesce disabled for %s", vdi)
                 continue
             if not (AUTO_ONLINE_LEAF_COALESCE_ENABLED or
                     vdi.getConfig(vdi.DB_LEAFCLSC) == vdi.LEAFCLSC_FORCE):
@@ -1665,7 +1946,7 @@ class SR:
                 self.cleanup()
                 raise
             else:
-                self._failedCoalesceTargets.append(vdi)
+                self._failedCoalesceTargets.add(vdi)
                 Util.logException("coalesce")
                 Util.log("Coalesce failed, skipping")
         self.cleanup()
@@ -1689,7 +1970,7 @@ class SR:
             self.cleanup()
             raise
         except (util.SMException, XenAPI.Failure) as e:
-            self._failedCoalesceTargets.append(vdi)
+            self._failedCoalesceTargets.add(vdi)
             Util.logException("leaf-coalesce")
             Util.log("Leaf-coalesce failed on %s, skipping" % vdi)
         self.cleanup()
@@ -1706,14 +1987,21 @@ class SR:
     def findGarbage(self):
         vdiList = []
         for vdi in self.vdiTrees:
-            vdiList.extend(vdi.getAllPrunable())
+            if vdi not in self._dirtyRoots:
+                continue
+            prunable = vdi.getAllPrunable()
+            if prunable:
+                vdiList.extend(prunable)
+            else:
+                # nothing to collect here until the tree changes again
+                self._dirtyRoots.discard(vdi)
         return vdiList
 
     def deleteVDIs(self, vdiList):
         for vdi in vdiList:
-            if IPCFlag(self.uuid).test(FLAG_TYPE_ABORT):
+            if self.abortFlag.test(FLAG_TYPE_ABORT):
                 raise AbortException("Aborting due to signal")
-            Util.log("Deleting unlinked VDI %s" % vdi)
+            Util.logf("Deleting unlinked VDI %s", vdi)
             self.deleteVDI(vdi)
 
     def deleteVDI(self, vdi):
@@ -1721,7 +2009,12 @@ class SR:
         del self.vdis[vdi.uuid]
         if vdi.parent:
             vdi.parent.children.remove(vdi)
-        if vdi in self.vdiTrees:
+            self._treeChanged(vdi.parent)
+        else:
+            self._scanEpoch += 1
+        if vdi in self._vdiTreeSet:
+            self._vdiTreeSet.discard(vdi)
+            self._dirtyRoots.discard(vdi)
             self.vdiTrees.remove(vdi)
         vdi.delete()
 
@@ -1729,16 +2022,19 @@ class SR:
         self.xapi.forgetVDI(self.uuid, vdiUuid)
 
     def pauseVDIs(self, vdiList):
-        paused = []
+        """Pause all the VDIs at once: the tap-pause calls for the whole list
+        are in flight together, and all of them have completed (or failed)
+        before this returns"""
         failed = False
-        for vdi in vdiList:
-            try:
-                vdi.pause()
-                paused.append(vdi)
-            except:
-                Util.logException("pauseVDIs")
-                failed = True
-                break
+        paused = []
+        try:
+            pausedUuids = blktap2.VDI.tap_pause_many(self.xapi.session,
+                    self.uuid, [vdi.uuid for vdi in vdiList])
+            paused = [vdi for vdi in vdiList if vdi.uuid in pausedUuids]
+            failed = len(paused) != len(vdiList)
+        except:
+            Util.logException("pauseVDIs")
+            failed = True
 
         if failed:
             self.unpauseVDIs(paused)
@@ -1746,11 +2042,12 @@ class SR:
 
     def unpauseVDIs(self, vdiList):
         failed = False
+        unpausedUuids = blktap2.VDI.tap_unpause_many(self.xapi.session,
+                self.uuid, [vdi.uuid for vdi in vdiList])
         for vdi in vdiList:
-            try:
-                vdi.unpause()
-            except:
+            if vdi.uuid not in unpausedUuids:
                 Util.log("ERROR: Failed to unpause VDI %s" % vdi)
+                vdi._report_tapdisk_unpause_error()
                 failed = True
         if failed:
             raise util.SMException("Failed to unpause VDIs")
@@ -1760,6 +2057,7 @@ class SR:
 
     def cleanup(self):
         Util.log("In cleanup")
+        self._forgetStorageSpeed()
         return
 
     def __str__(self):
@@ -1777,14 +2075,18 @@ class SR:
             return
 
         if self._locked == 0 :
-            abortFlag = IPCFlag(self.uuid)
+            abortFlag = self.abortFlag
+            if self._srLock.acquireNoblock():
+                self._locked += 1
+                return
+            # wait on the lock itself so that we get it as soon as it is
+            # released, waking up every LOCK_RETRY_INTERVAL to check for abort
             for i in range(SR.LOCK_RETRY_ATTEMPTS_LOCK):
-                if self._srLock.acquireNoblock():
-                    self._locked += 1
-                    return
                 if abortFlag.test(FLAG_TYPE_ABORT):
                     raise AbortException("Abort requested")
-                time.sleep(SR.LOCK_RETRY_INTERVAL)
+                if self._srLock.acquireTimeout(SR.LOCK_RETRY_INTERVAL):
+                    self._locked += 1
+                    return
             raise util.SMException("Unable to acquire the SR lock")
 
         self._locked += 1
@@ -1798,30 +2100,27 @@ class SR:
             self._srLock.release()
 
     def needUpdateBlockInfo(self):
-        for vdi in self.vdis.values():
-            if vdi.scanError or len(vdi.children) == 0:
-                continue
+        for vdi in self._categorize()[2]:
             if not vdi.getConfig(vdi.DB_VHD_BLOCKS):
                 return True
         return False
 
     def updateBlockInfo(self):
-        for vdi in self.vdis.values():
-            if vdi.scanError or len(vdi.children) == 0:
-                continue
+        for vdi in self._categorize()[2]:
             if not vdi.getConfig(vdi.DB_VHD_BLOCKS):
                 vdi.updateBlockInfo()
 
     def cleanupCoalesceJournals(self):
         """Remove stale coalesce VDI indicators"""
         entries = self.journaler.getAll(VDI.JRN_COALESCE)
-        for uuid, jval in entries.iteritems():
-            self.journaler.remove(VDI.JRN_COALESCE, uuid)
+        if entries:
+            self.journaler.removeMany(VDI.JRN_COALESCE, entries.keys())
 
     def cleanupJournals(self, dryRun):
         """delete journal entries for non-existing VDIs"""
         for t in [LVHDVDI.JRN_ZERO, VDI.JRN_RELINK, SR.JRN_CLONE]:
             entries = self.journaler.getAll(t)
+            stale = []
             for uuid, jval in entries.iteritems():
                 if self.getVDI(uuid):
                     continue
@@ -1829,10 +2128,11 @@ class SR:
                     baseUuid, clonUuid = jval.split("_")
                     if self.getVDI(baseUuid):
                         continue
-                Util.log("  Deleting stale '%s' journal entry for %s "
-                        "(%s)" % (t, uuid, jval))
-                if not dryRun:
-                    self.journaler.remove(t, uuid)
+                Util.logf("  Deleting stale '%s' journal entry for %s (%s)",
+                        t, uuid, jval)
+                stale.append(uuid)
+            if stale and not dryRun:
+                self.journaler.removeMany(t, stale)
 
     def cleanupCache(self, maxAge = -1):
         return 0
@@ -1875,12 +2175,17 @@ class SR:
         MAX_ITERATIONS_NO_PROGRESS = 3
         MAX_ITERATIONS = 10
         MAX_INCREASE_FROM_MINIMUM = 1.2
+        # an iteration that shrinks the VHD by at least this fraction earns
+        # one more iteration, up to MAX_GRACE_ITERATIONS extra in total
+        GOOD_PROGRESS_RATIO = 0.05
+        MAX_GRACE_ITERATIONS = 5
         HISTORY_STRING = "Iteration: {its} -- Initial size {initSize}" \
                          " --> Final size {finSize}"
 
         def __init__(self):
             self.itsNoProgress = 0
             self.its = 0
+            self.graceIts = 0
             self.minSize = float("inf")
             self.history = []
             self.reason = ""
@@ -1910,9 +2215,14 @@ class SR:
                 self.itsNoProgress += 1
                 Util.log("No progress, attempt:"
                          " {attempt}".format(attempt=self.itsNoProgress))
-
-            if (not res) and (self.its > self.MAX_ITERATIONS):
-                max = self.MAX_ITERATIONS
+            elif (prevSize - curSize > self.GOOD_PROGRESS_RATIO * prevSize and
+                    self.graceIts < self.MAX_GRACE_ITERATIONS):
+                # still converging quickly: don't give up on it too early
+                self.graceIts += 1
+
+            if (not res) and \
+                    (self.its > self.MAX_ITERATIONS + self.graceIts):
+                max = self.MAX_ITERATIONS + self.graceIts
                 self.reason =\
                     "Max iterations ({max}) exceeded".format(max=max)
                 res = True
@@ -1949,7 +2259,7 @@ class SR:
         complete due to external changes, namely vdi_delete and vdi_snapshot 
         that alter leaf-coalescibility of vdi"""
         tracker = self.CoalesceTracker()
-        while not vdi.canLiveCoalesce(self.getStorageSpeed()):
+        while not vdi.canLiveCoalesce(self._getStorageSpeedCached()):
             prevSizeVHD = vdi.getSizeVHD()
             if not self._snapshotCoalesce(vdi):
                 return False
@@ -1997,6 +2307,7 @@ class SR:
             return
 
         self.writeSpeedToFile(speed)
+        self._forgetStorageSpeed()
 
     def getStorageSpeed(self):
         speedFile = None
@@ -2033,6 +2344,20 @@ class SR:
                 speedFile.close()
             self.unlock()
 
+    def _getStorageSpeedCached(self):
+        """getStorageSpeed() for use in loops. The speed log is written by
+        recordStorageSpeed, which runs in the runAbortable child of
+        VDI._coalesceVHD: the parent drops the cached value with
+        _forgetStorageSpeed once that child is done"""
+        valid, speed = self._storageSpeed
+        if not valid:
+            speed = self.getStorageSpeed()
+            self._storageSpeed = (True, speed)
+        return speed
+
+    def _forgetStorageSpeed(self):
+        self._storageSpeed = (False, None)
+
     def _snapshotCoalesce(self, vdi):
         # Note that because we are not holding any locks here, concurrent SM 
         # operations may change this tree under our feet. In particular, vdi 
@@ -2055,7 +2380,6 @@ class SR:
             return False
         Util.log("Coalescing parent %s" % tempSnap)
         util.fistpoint.activate("LVHDRT_coaleaf_delay_2", self.uuid)
-        vhdSize = vdi.getSizeVHD()
         self._coalesce(tempSnap)
         if not vdi.isLeafCoalesceable():
             Util.log("The VDI tree appears to have been altered since")
@@ -2102,6 +2426,7 @@ class SR:
     def _doCoalesceLeaf(self, vdi):
         """Actual coalescing of a leaf VDI onto parent. Must be called in an
         offline/atomic context"""
+        vdi._extraSpaceCache = (None, None)
         self.journaler.create(VDI.JRN_LEAF, vdi.uuid, vdi.parent.uuid)
         self._prepareCoalesceLeaf(vdi)
         vdi.parent._setHidden(False)
@@ -2146,6 +2471,7 @@ class SR:
         vdi._setHidden(True)
         vdi.parent.children = []
         vdi.parent = None
+        self._treeChanged(parent)
 
         extraSpace = self._calcExtraSpaceNeeded(vdi, parent)
         freeSpace = self.getFreeSpace()
@@ -2190,11 +2516,18 @@ class SR:
         pass
 
     def _removeStaleVDIs(self, uuidsPresent):
-        for uuid in self.vdis.keys():
-            if not uuid in uuidsPresent:
-                Util.log("VDI %s disappeared since last scan" % \
-                        self.vdis[uuid])
-                del self.vdis[uuid]
+        for uuid in set(self.vdis) - set(uuidsPresent):
+            Util.log("VDI %s disappeared since last scan" % self.vdis[uuid])
+            del self.vdis[uuid]
+
+    def _scanRetrySleep(self, attempt):
+        """Back off (exponentially, with jitter) before retrying a scan that
+        failed on the given attempt, to let concurrent VHD updates settle"""
+        if attempt + 1 >= self.SCAN_RETRY_ATTEMPTS:
+            return
+        delay = min(self.SCAN_RETRY_MAX_SLEEP,
+                self.SCAN_RETRY_BASE_SLEEP * (2 ** attempt))
+        time.sleep(delay * (0.5 + random.random()))
 
     def _handleInterruptedCoalesceLeaf(self):
         """An interrupted leaf-coalesce operation may leave the VHD tree in an 
@@ -2204,8 +2537,20 @@ class SR:
         # abstract
         pass
 
+    def _leafCoalesceRecovered(self, uuids):
+        """Drop the JRN_LEAF entries of the leaf-coalesces that have been
+        undone or finished, all in one go, and only then unpause the VDIs"""
+        if not uuids:
+            return
+        self.journaler.removeMany(VDI.JRN_LEAF, uuids)
+        for uuid in uuids:
+            vdi = self.getVDI(uuid)
+            if vdi:
+                vdi.ensureUnpaused()
+
     def _buildTree(self, force):
         self.vdiTrees = []
+        self._scanEpoch += 1
         for vdi in self.vdis.values():
             if vdi.parentUuid:
                 parent = self.getVDI(vdi.parentUuid)
@@ -2225,11 +2570,23 @@ class SR:
                 parent.children.append(vdi)
             else:
                 self.vdiTrees.append(vdi)
+        self._vdiTreeSet = set(self.vdiTrees)
+        # anything may have changed behind our back: search every tree again
+        self._dirtyRoots = set(self.vdiTrees)
+
+    def _treeChanged(self, vdi):
+        """Note a change in the shape or hidden flags of the tree that vdi
+        belongs to: the per-epoch caches are invalidated and the tree is
+        searched for garbage again"""
+        self._scanEpoch += 1
+        self._dirtyRoots.add(vdi.getTreeRoot())
 
 
 class FileSR(SR):
     TYPE = SR.TYPE_FILE
     CACHE_FILE_EXT = ".vhdcache"
+    CACHE_FILE_EXT_LEN = len(CACHE_FILE_EXT)
+    CACHE_FILE_NAME_LEN = Util.UUID_LEN + CACHE_FILE_EXT_LEN
     # cache cleanup actions
     CACHE_ACTION_KEEP = 0
     CACHE_ACTION_REMOVE = 1
@@ -2252,12 +2609,12 @@ class FileSR(SR):
                 vdi = FileVDI(self, uuid, False)
                 self.vdis[uuid] = vdi
             vdi.load(vhdInfo)
-        uuidsPresent = vhds.keys()
+        uuidsPresent = set(vhds.iterkeys())
         rawList = filter(lambda x: x.endswith(vhdutil.FILE_EXTN_RAW),
                 os.listdir(self.path))
         for rawName in rawList:
             uuid = FileVDI.extractUuid(rawName)
-            uuidsPresent.append(uuid)
+            uuidsPresent.add(uuid)
             vdi = self.getVDI(uuid)
             if not vdi:
                 self.logFilter.logNewVDI(uuid)
@@ -2293,11 +2650,17 @@ class FileSR(SR):
         numRemoved = 0
         cacheFiles = filter(self._isCacheFileName, os.listdir(self.path))
         Util.log("Found %d cache files" % len(cacheFiles))
-        cutoff = datetime.datetime.now() - datetime.timedelta(hours = maxAge)
+        if not cacheFiles:
+            return numRemoved
+        # the cached VDIs live on other SRs: one call for all the records
+        # beats a round trip per cache file. _cleanupCache re-checks the
+        # record under the cache lock before removing anything
+        records = self.xapi.getAllRecordsVDI()
+        cutoff = time.time() - maxAge * 60 * 60
         for cacheFile in cacheFiles:
-            uuid = cacheFile[:-len(self.CACHE_FILE_EXT)]
+            uuid = cacheFile[:-self.CACHE_FILE_EXT_LEN]
             action = self.CACHE_ACTION_KEEP
-            rec = self.xapi.getRecordVDI(uuid)
+            rec = records.get(uuid)
             if not rec:
                 Util.log("Cache %s: VDI doesn't exist" % uuid)
                 action = self.CACHE_ACTION_REMOVE
@@ -2305,8 +2668,8 @@ class FileSR(SR):
                 Util.log("Cache %s: caching disabled" % uuid)
                 action = self.CACHE_ACTION_REMOVE
             elif not rec["managed"] and maxAge >= 0:
-                lastAccess = datetime.datetime.fromtimestamp( \
-                        os.path.getatime(os.path.join(self.path, cacheFile)))
+                lastAccess = os.path.getatime(os.path.join(self.path,
+                        cacheFile))
                 if lastAccess < cutoff:
                     Util.log("Cache %s: older than %d hrs" % (uuid, maxAge))
                     action = self.CACHE_ACTION_REMOVE_IF_INACTIVE
@@ -2352,7 +2715,7 @@ class FileSR(SR):
         return True
 
     def _isCacheFileName(self, name):
-        return (len(name) == Util.UUID_LEN + len(self.CACHE_FILE_EXT)) and \
+        return len(name) == self.CACHE_FILE_NAME_LEN and \
                 name.endswith(self.CACHE_FILE_EXT)
 
     def _scan(self, force):
@@ -2367,6 +2730,7 @@ class FileSR(SR):
             if not error:
                 return vhds
             Util.log("Scan error on attempt %d" % i)
+            self._scanRetrySleep(i)
         if force:
             return vhds
         raise util.SMException("Scan error")
@@ -2377,42 +2741,46 @@ class FileSR(SR):
 
     def _checkSlaves(self, vdi):
         onlineHosts = self.xapi.getOnlineHosts()
-        abortFlag = IPCFlag(self.uuid)
+        if self.abortFlag.test(FLAG_TYPE_ABORT):
+            raise AbortException("Aborting due to signal")
+        args = { 'path': vdi.path }
+        hostRefs = []
         for pbdRecord in self.xapi.getAttachedPBDs():
             hostRef = pbdRecord["host"]
             if hostRef == self.xapi._hostRef:
                 continue
-            if abortFlag.test(FLAG_TYPE_ABORT):
-                raise AbortException("Aborting due to signal")
-            try:
-                self._checkSlave(hostRef, vdi)
-            except util.CommandException:
-                if hostRef in onlineHosts:
-                    raise
-
-    def _checkSlave(self, hostRef, vdi):
-        call  = (hostRef, "nfs-on-slave", "check", { 'path': vdi.path })
-        Util.log("Checking with slave: %s" % repr(call))
-        _host = self.xapi.session.xenapi.host
-        text  = _host.call_plugin(*call)
+            Util.log("Checking with slave: %s" % \
+                    repr((hostRef, "nfs-on-slave", "check", args)))
+            hostRefs.append(hostRef)
+        results, failures = self.xapi.callPluginOnHosts(hostRefs,
+                "nfs-on-slave", "check", args, self.abortFlag)
+        for hostRef, e in failures.iteritems():
+            if hostRef in onlineHosts:
+                raise e
 
     def _handleInterruptedCoalesceLeaf(self):
         entries = self.journaler.getAll(VDI.JRN_LEAF)
-        for uuid, parentUuid in entries.iteritems():
-            fileList = os.listdir(self.path)
-            childName = uuid + vhdutil.FILE_EXTN_VHD
-            tmpChildName = self.TMP_RENAME_PREFIX + uuid + vhdutil.FILE_EXTN_VHD
-            parentName1 = parentUuid + vhdutil.FILE_EXTN_VHD
-            parentName2 = parentUuid + vhdutil.FILE_EXTN_RAW
-            parentPresent = (parentName1 in fileList or parentName2 in fileList)
-            if parentPresent or tmpChildName in fileList:
-                self._undoInterruptedCoalesceLeaf(uuid, parentUuid)
-            else:
-                self._finishInterruptedCoalesceLeaf(uuid, parentUuid)
-            self.journaler.remove(VDI.JRN_LEAF, uuid)
-            vdi = self.getVDI(uuid)
-            if vdi:
-                vdi.ensureUnpaused()
+        if not entries:
+            return
+        # the undo/finish steps only rename the files of their own entry, so
+        # one listing serves all the entries
+        fileList = set(os.listdir(self.path))
+        done = []
+        try:
+            for uuid, parentUuid in entries.iteritems():
+                tmpChildName = self.TMP_RENAME_PREFIX + uuid + \
+                        vhdutil.FILE_EXTN_VHD
+                parentName1 = parentUuid + vhdutil.FILE_EXTN_VHD
+                parentName2 = parentUuid + vhdutil.FILE_EXTN_RAW
+                parentPresent = (parentName1 in fileList or \
+                        parentName2 in fileList)
+                if parentPresent or tmpChildName in fileList:
+                    self._undoInterruptedCoalesceLeaf(uuid, parentUuid)
+                else:
+                    self._finishInterruptedCoalesceLeaf(uuid, parentUuid)
+                done.append(uuid)
+        finally:
+            self._leafCoalesceRecovered(done)
 
     def _undoInterruptedCoalesceLeaf(self, childUuid, parentUuid):
         Util.log("*** UNDO LEAF-COALESCE")
@@ -2491,12 +2859,13 @@ class LVHDSR(SR):
         return stats['physical_size'] - stats['physical_utilisation']
 
     def cleanup(self):
+        self._forgetStorageSpeed()
         if not self.lvActivator.deactivateAll():
             Util.log("ERROR deactivating LVs while cleaning up")
 
     def needUpdateBlockInfo(self):
-        for vdi in self.vdis.values():
-            if vdi.scanError or vdi.raw or len(vdi.children) == 0:
+        for vdi in self._categorize()[2]:
+            if vdi.raw:
                 continue
             if not vdi.getConfig(vdi.DB_VHD_BLOCKS):
                 return True
@@ -2504,8 +2873,8 @@ class LVHDSR(SR):
 
     def updateBlockInfo(self):
         numUpdated = 0
-        for vdi in self.vdis.values():
-            if vdi.scanError or vdi.raw or len(vdi.children) == 0:
+        for vdi in self._categorize()[2]:
+            if vdi.raw:
                 continue
             if not vdi.getConfig(vdi.DB_VHD_BLOCKS):
                 vdi.updateBlockInfo()
@@ -2544,18 +2913,17 @@ class LVHDSR(SR):
             if not error:
                 return vdis
             Util.log("Scan error, retrying (%d)" % i)
+            self._scanRetrySleep(i)
         if force:
             return vdis
         raise util.SMException("Scan error")
 
     def _removeStaleVDIs(self, uuidsPresent):
-        for uuid in self.vdis.keys():
-            if not uuid in uuidsPresent:
-                Util.log("VDI %s disappeared since last scan" % \
-                        self.vdis[uuid])
-                del self.vdis[uuid]
-                if self.lvActivator.get(uuid, False):
-                    self.lvActivator.remove(uuid, False)
+        for uuid in set(self.vdis) - set(uuidsPresent):
+            Util.log("VDI %s disappeared since last scan" % self.vdis[uuid])
+            del self.vdis[uuid]
+            if self.lvActivator.get(uuid, False):
+                self.lvActivator.remove(uuid, False)
 
     def _liveLeafCoalesce(self, vdi):
         """If the parent is raw and the child was resized (virt. size), then
@@ -2599,22 +2967,23 @@ class LVHDSR(SR):
 
     def _handleInterruptedCoalesceLeaf(self):
         entries = self.journaler.getAll(VDI.JRN_LEAF)
-        for uuid, parentUuid in entries.iteritems():
-            childLV = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + uuid
-            tmpChildLV = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + \
-                    self.TMP_RENAME_PREFIX + uuid
-            parentLV1 = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + parentUuid
-            parentLV2 = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_RAW] + parentUuid
-            parentPresent = (self.lvmCache.checkLV(parentLV1) or \
-                    self.lvmCache.checkLV(parentLV2))
-            if parentPresent or self.lvmCache.checkLV(tmpChildLV):
-                self._undoInterruptedCoalesceLeaf(uuid, parentUuid)
-            else:
-                self._finishInterruptedCoalesceLeaf(uuid, parentUuid)
-            self.journaler.remove(VDI.JRN_LEAF, uuid)
-            vdi = self.getVDI(uuid)
-            if vdi:
-                vdi.ensureUnpaused()
+        vhdPrefix = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD]
+        rawPrefix = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_RAW]
+        done = []
+        try:
+            for uuid, parentUuid in entries.iteritems():
+                tmpChildLV = vhdPrefix + self.TMP_RENAME_PREFIX + uuid
+                parentLV1 = vhdPrefix + parentUuid
+                parentLV2 = rawPrefix + parentUuid
+                parentPresent = (self.lvmCache.checkLV(parentLV1) or \
+                        self.lvmCache.checkLV(parentLV2))
+                if parentPresent or self.lvmCache.checkLV(tmpChildLV):
+                    self._undoInterruptedCoalesceLeaf(uuid, parentUuid)
+                else:
+                    self._finishInterruptedCoalesceLeaf(uuid, parentUuid)
+                done.append(uuid)
+        finally:
+            self._leafCoalesceRecovered(done)
 
     def _undoInterruptedCoalesceLeaf(self, childUuid, parentUuid):
         Util.log("*** UNDO LEAF-COALESCE")
@@ -2656,10 +3025,16 @@ class LVHDSR(SR):
         util.fistpoint.activate("LVHDRT_coaleaf_undo_after_deflate", self.uuid)
         if child.hidden:
             child._setHidden(False)
-        if not parent.hidden:
-            parent._setHidden(True)
-        if not parent.lvReadonly:
-            self.lvmCache.setReadonly(parent.fileName, True)
+        if parent.raw:
+            # hide and re-protect the raw parent in one metadata commit
+            self.lvmCache.apply(parent.fileName, readonly=True, hidden=True)
+            parent.hidden = True
+            self._treeChanged(parent)
+        else:
+            if not parent.hidden:
+                parent._setHidden(True)
+            if not parent.lvReadonly:
+                self.lvmCache.setReadonly(parent.fileName, True)
         self._updateSlavesOnUndoLeafCoalesce(parent, child)
         util.fistpoint.activate("LVHDRT_coaleaf_undo_end", self.uuid)
         Util.log("*** leaf-coalesce undo successful")
@@ -2693,20 +3068,23 @@ class LVHDSR(SR):
                 "uuid2"  : vdi.uuid,
                 "ns2"    : lvhdutil.NS_PREFIX_LVM + self.uuid}
         onlineHosts = self.xapi.getOnlineHosts()
-        abortFlag = IPCFlag(self.uuid)
+        if self.abortFlag.test(FLAG_TYPE_ABORT):
+            raise AbortException("Aborting due to signal")
+        hostRefs = []
         for pbdRecord in self.xapi.getAttachedPBDs():
             hostRef = pbdRecord["host"]
             if hostRef == self.xapi._hostRef:
                 continue
-            if abortFlag.test(FLAG_TYPE_ABORT):
-                raise AbortException("Aborting due to signal")
             Util.log("Checking with slave %s (path %s)" % (
                 self.xapi.getRecordHost(hostRef)['hostname'], vdi.path))
-            try:
-                self.xapi.ensureInactive(hostRef, args)
-            except XenAPI.Failure:
-                if hostRef in onlineHosts:
-                    raise
+            hostRefs.append(hostRef)
+        results, failures = self.xapi.callPluginOnHosts(hostRefs,
+                self.xapi.PLUGIN_ON_SLAVE, "multi", args, self.abortFlag)
+        for text in results.itervalues():
+            Util.log("call-plugin returned: '%s'" % text)
+        for hostRef, e in failures.iteritems():
+            if hostRef in onlineHosts:
+                raise e
 
     def _updateSlavesOnUndoLeafCoalesce(self, parent, child):
         slaves = util.get_slaves_attached_on(self.xapi.session, [child.uuid])
@@ -2730,9 +3108,7 @@ class LVHDSR(SR):
             Util.log("Updating %s, %s, %s on slave %s" % \
                     (tmpName, child.fileName, parent.fileName,
                      self.xapi.getRecordHost(slave)['hostname']))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        self._callOnSlaves(slaves, args)
 
     def _updateSlavesOnRename(self, vdi, oldNameLV, origParentUuid):
         slaves = util.get_slaves_attached_on(self.xapi.session, [vdi.uuid])
@@ -2752,18 +3128,28 @@ class LVHDSR(SR):
             Util.log("Updating %s to %s on slave %s" % \
                     (oldNameLV, vdi.fileName,
                      self.xapi.getRecordHost(slave)['hostname']))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
+        self._callOnSlaves(slaves, args)
+
+    def _callOnSlaves(self, slaves, args):
+        """Run the on-slave "multi" plugin with args on all the slaves in
+        parallel; raise the first failure once all the calls are done"""
+        results, failures = self.xapi.callPluginOnHosts(slaves,
+                self.xapi.PLUGIN_ON_SLAVE, "multi", args)
+        for text in results.itervalues():
             Util.log("call-plugin returned: '%s'" % text)
+        for e in failures.itervalues():
+            raise e
 
     def _updateSlavesOnResize(self, vdi):
-        uuids = map(lambda x: x.uuid, vdi.getAllLeaves())
+        uuids = [leaf.uuid for leaf in vdi._iterLeaves()]
         slaves = util.get_slaves_attached_on(self.xapi.session, uuids)
         if not slaves:
             util.SMlog("Update-on-resize: %s not attached on any slave" % vdi)
             return
-        lvhdutil.lvRefreshOnSlaves(self.xapi.session, self.uuid, self.vgName,
-                vdi.fileName, vdi.uuid, slaves)
+        for slave in slaves:
+            Util.log("Refreshing %s on slave %s" % (vdi.fileName, slave))
+        self._callOnSlaves(slaves, lvhdutil.lvRefreshArgs(self.uuid,
+                self.vgName, vdi.fileName, vdi.uuid))
 
 
 ################################################################################
@@ -2833,15 +3219,12 @@ def _gcLoopPause(sr, dryRun):
                                           lambda *args: None)
     elif os.path.exists(_gc_init_file(sr.uuid)):
         def abortTest():
-            return IPCFlag(sr.uuid).test(FLAG_TYPE_ABORT)
+            return sr.abortFlag.test(FLAG_TYPE_ABORT)
 
-        # If time.sleep hangs we are in deep trouble, however for
-        # completeness we set the timeout of the abort thread to
-        # 110% of GCPAUSE_DEFAULT_SLEEP.
+        # nothing to run in the meantime: no need for a runAbortable child
         Util.log("GC active, about to go quiet")
-        Util.runAbortable(lambda: time.sleep(GCPAUSE_DEFAULT_SLEEP),
-                          None, sr.uuid, abortTest, VDI.POLL_INTERVAL,
-                          GCPAUSE_DEFAULT_SLEEP*1.1)
+        Util.abortableSleep(GCPAUSE_DEFAULT_SLEEP, abortTest,
+                            VDI.POLL_INTERVAL)
         Util.log("GC active, quiet period ended")
 
 def _gcLoop(sr, dryRun):
@@ -2873,7 +3256,7 @@ def _gcLoop(sr, dryRun):
                 sr.cleanupCoalesceJournals()
                 # Create the init file here in case startup is waiting on it
                 _create_init_file(sr.uuid)
-                sr.scanLocked()
+                sr.scanLocked(maxAge=SR.SCAN_FRESH_INTERVAL)
                 sr.updateBlockInfo()
 
                 howmany = len(sr.findGarbage())
@@ -3090,23 +3473,20 @@ def should_preempt(session, srUuid):
         raise util.SMException("More than one coalesce entry: " + str(entries))
     sr.scanLocked()
     coalescedUuid = entries.popitem()[0]
-    garbage = sr.findGarbage()
-    for vdi in garbage:
-        if vdi.uuid == coalescedUuid:
-            return True
-    return False
+    vdi = sr.getVDI(coalescedUuid)
+    if not vdi:
+        return False
+    # only the tree being coalesced matters: don't walk all the others
+    return vdi in vdi.getTreeRoot().getAllPrunable()
 
 def get_coalesceable_leaves(session, srUuid, vdiUuids):
-    coalesceable = []
     sr = SR.getInstance(srUuid, session)
     sr.scanLocked()
+    vdis = sr.getVDIs(vdiUuids)
     for uuid in vdiUuids:
-        vdi = sr.getVDI(uuid)
-        if not vdi:
+        if uuid not in vdis:
             raise util.SMException("VDI %s not found" % uuid)
-        if vdi.isLeafCoalesceable():
-            coalesceable.append(uuid)
-    return coalesceable
+    return [uuid for uuid in vdiUuids if vdis[uuid].isLeafCoalesceable()]
 
 def cache_cleanup(session, srUuid, maxAge):
     sr = SR.getInstance(srUuid, session)
@@ -3141,14 +3521,42 @@ def debug(sr_uuid, cmd, vdi_uuid):
     print("VDI after:  %s" % vdi)
 
 
+def _waitForSignal(signums):
+    """Block until one of the signals in signums is delivered and return it.
+    The previous handlers are restored before returning. The wait is a
+    bounded select rather than signal.pause(): a signal landing between the
+    check and the pause would otherwise be missed and the wait would never
+    end."""
+    received = []
+    def handler(signum, frame):
+        received.append(signum)
+    oldHandlers = [(signum, signal.signal(signum, handler))
+            for signum in signums]
+    try:
+        while not received:
+            try:
+                select.select([], [], [], SIGNAL_WAIT_POLL_INTERVAL)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+    finally:
+        for signum, oldHandler in oldHandlers:
+            signal.signal(signum, oldHandler)
+    return received[0]
+
 def abort_optional_reenable(uuid):
     print("Disabling GC/coalesce for %s" % uuid)
     ret = _abort(uuid)
-    raw_input("Press enter to re-enable...")
-    print("GC/coalesce re-enabled")
-    lockRunning.release()
-    if ret:
-        lockActive.release()
+    try:
+        print("Send SIGUSR1 (kill -USR1 %d) or press Ctrl-C to re-enable..." %
+                os.getpid())
+        sys.stdout.flush()
+        _waitForSignal([signal.SIGUSR1, signal.SIGINT])
+    finally:
+        print("GC/coalesce re-enabled")
+        lockRunning.release()
+        if ret:
+            lockActive.release()
 
 ##############################################################################
 #
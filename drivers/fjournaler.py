@@ -54,6 +54,15 @@ class Journaler:
         path = self._getPath(type, id)
         os.unlink(path)
 
+    def removeMany(self, type, ids):
+        """Remove the entries of type "type" for all of "ids". Error if any
+        of the entries doesn't exist, in which case nothing is removed."""
+        for id in ids:
+            if not self.get(type, id):
+                raise JournalerException("No journal for '%s:%s'" % (type, id))
+        for id in ids:
+            os.unlink(self._getPath(type, id))
+
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
         Return None if no such entry exists"""
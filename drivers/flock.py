@@ -25,6 +25,8 @@ got to grow our own.
 
 import os, fcntl, struct
 import errno
+import signal
+import time
 
 class Flock:
     """A C flock struct."""
@@ -104,6 +106,48 @@ class FcntlLockBase:
         self._held = True
         return True
 
+    # how often SIGALRM is repeated once timedlock's timeout has expired, in
+    # case the first alarm fired just before F_SETLKW started blocking
+    TIMEDLOCK_REARM_INTERVAL = 0.1 # seconds
+
+    def timedlock(self, timeout):
+        """Blocking lock aquisition that gives up after @timeout seconds.
+        Returns True on success, False on timeout.
+
+        The wait is interrupted with SIGALRM from ITIMER_REAL, so this must
+        only be called from the main thread (signal.signal raises ValueError
+        otherwise). A timer already armed by the caller (e.g. signal.alarm)
+        is suspended during the wait and re-armed afterwards with the time
+        it had left, along with its SIGALRM handler."""
+        if self._held: return False
+        timedOut = []
+        def _timedout(signum, frame):
+            timedOut.append(signum)
+        start = time.time()
+        oldHandler = signal.signal(signal.SIGALRM, _timedout)
+        oldDelay, oldInterval = signal.setitimer(signal.ITIMER_REAL,
+                timeout, self.TIMEDLOCK_REARM_INTERVAL)
+        try:
+            while not timedOut:
+                try:
+                    Flock(self.LOCK_TYPE).fcntl(self.fd, fcntl.F_SETLKW)
+                except IOError as e:
+                    # interrupted by another signal: the timer keeps
+                    # running, so retry for the rest of the timeout
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                self._held = True
+                return True
+            return False
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, oldHandler)
+            if oldDelay > 0:
+                # a timer that expired while we waited fires straight away
+                delay = max(oldDelay - (time.time() - start), 1e-6)
+                signal.setitimer(signal.ITIMER_REAL, delay, oldInterval)
+
     def held(self):
         """Returns True if @self holds the lock, False otherwise."""
         return self._held
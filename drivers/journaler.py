@@ -101,12 +101,18 @@ class Journaler:
         val = self.get(type, id)
         if not val:
             raise JournalerException("No journal for '%s:%s'" % (type, id))
-        lvName = self._getNameLV(type, id, val)
+        self._removeLV(type, id, val)
 
-        mapperDevice = self._getLVMapperName(lvName)
-        if len(mapperDevice) > LVM_MAX_NAME_LEN:
-            lvName = self._getNameLV(type, id)
-        self.lvmCache.remove(lvName)
+    def removeMany(self, type, ids):
+        """Remove the entries of type "type" for all of "ids", reading the
+        journal entries only once. Error if any of the entries doesn't
+        exist, in which case nothing is removed."""
+        entries = self.getAll(type)
+        for id in ids:
+            if not entries.get(id):
+                raise JournalerException("No journal for '%s:%s'" % (type, id))
+        for id in ids:
+            self._removeLV(type, id, entries[id])
 
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
@@ -132,6 +138,14 @@ class Journaler:
                 return True
         return False
 
+    def _removeLV(self, type, id, val):
+        lvName = self._getNameLV(type, id, val)
+
+        mapperDevice = self._getLVMapperName(lvName)
+        if len(mapperDevice) > LVM_MAX_NAME_LEN:
+            lvName = self._getNameLV(type, id)
+        self.lvmCache.remove(lvName)
+
     def _getNameLV(self, type, id, val = 1):
         return "%s%s%s%s%s" % (type, self.SEPARATOR, id, self.SEPARATOR, val)
 
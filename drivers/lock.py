@@ -53,6 +53,9 @@ class Lock(object):
     def acquireNoblock(self):
         raise NotImplementedError("Lock methods implemented in LockImplementation")
 
+    def acquireTimeout(self, timeout):
+        raise NotImplementedError("Lock methods implemented in LockImplementation")
+
     def release(self):
         raise NotImplementedError("Lock methods implemented in LockImplementation")
 
@@ -246,6 +249,24 @@ class LockImplementation(object):
 
         return ret
 
+    def acquireTimeout(self, timeout):
+        """Acquire lock, waiting at most timeout seconds for it to be
+        released. Return false if it is still held by someone else.
+        The wait relies on SIGALRM, so this must only be called from the
+        main thread; see FcntlLockBase.timedlock"""
+        if not self.held():
+            ret = self.lock.timedlock(timeout)
+            if VERBOSE:
+                util.SMlog("lock: waited %ss for %s, acquired: %s" % \
+                        (timeout, self.lockpath, ret))
+        else:
+            ret = True
+
+        if ret:
+            self.count += 1
+
+        return ret
+
     def held(self):
         """True if @self acquired the lock, False otherwise."""
         return self.lock.held()
@@ -284,8 +284,9 @@ def getAllVHDJournals(lvmCache):
         journals.append((jName, lvName))
     return journals
 
-def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
-    args = {"vgName" : vgName,
+def lvRefreshArgs(srUuid, vgName, lvName, vdiUuid):
+    """The on-slave "multi" arguments that refresh lvName on a slave"""
+    return {"vgName" : vgName,
             "action1": "activate",
             "uuid1"  : vdiUuid,
             "ns1"    : NS_PREFIX_LVM + srUuid,
@@ -296,6 +297,9 @@ def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
             "uuid3"  : vdiUuid,
             "ns3"    : NS_PREFIX_LVM + srUuid,
             "lvName3": lvName}
+
+def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
+    args = lvRefreshArgs(srUuid, vgName, lvName, vdiUuid)
     for slave in slaves:
         util.SMlog("Refreshing %s on slave %s" % (lvName, slave))
         text = session.xenapi.host.call_plugin(slave, "on-slave", "multi", args)
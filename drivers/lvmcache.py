@@ -234,6 +234,38 @@ class LVMCache:
             lock.release()
             self.lvs[lvName].readonly = readonly
 
+    @lazyInit
+    def apply(self, lvName, readonly=None, hidden=None):
+        """Bring the LV to the requested permission/hidden state, issuing at
+        most one lvchange for whatever actually differs from the cache"""
+        path = self._getPath(lvName)
+        lvInfo = self.lvs[lvName]
+        if readonly == lvInfo.readonly:
+            readonly = None
+        if hidden is not None and \
+                hidden == (lvutil.LV_TAG_HIDDEN in lvInfo.tags):
+            hidden = None
+        if readonly is None and hidden is None:
+            return
+        lock = None
+        if readonly is not None:
+            uuids = util.findall_uuid(path)
+            ns = lvhdutil.NS_PREFIX_LVM + uuids[0]
+            # see setReadonly
+            lock = Lock("lvchange-p", ns)
+            lock.acquire()
+        try:
+            lvutil.setFlags(path, readonly, hidden)
+        finally:
+            if lock:
+                lock.release()
+        if readonly is not None:
+            lvInfo.readonly = readonly
+        if hidden:
+            self._addTag(lvName, lvutil.LV_TAG_HIDDEN)
+        elif hidden is not None:
+            self._removeTag(lvName, lvutil.LV_TAG_HIDDEN)
+
     @lazyInit
     def changeOpen(self, lvName, inc):
         """We don't actually open or close the LV, just mark it in the cache"""
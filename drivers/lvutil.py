@@ -561,6 +561,17 @@ def setReadonly(path, readonly):
         val += "w"
     ret = cmd_lvm([CMD_LVCHANGE, path, "-p", val], pread_func=util.pread)
 
+def setFlags(path, readonly=None, hidden=None):
+    """Change the permission and/or hidden tag of an LV with a single
+    lvchange, i.e. a single VG metadata commit"""
+    cmd = [CMD_LVCHANGE, path]
+    if readonly is not None:
+        cmd += ["-p", readonly and "r" or "rw"]
+    if hidden is not None:
+        cmd += [hidden and "--addtag" or "--deltag", LV_TAG_HIDDEN]
+    if len(cmd) > 2:
+        cmd_lvm(cmd, pread_func=util.pread)
+
 def exists(path):
     (rc, stdout, stderr) = cmd_lvm([CMD_LVS, "--noheadings", path], pread_func=util.doexec)
     return rc == 0
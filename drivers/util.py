@@ -22,6 +22,7 @@ from __future__ import print_function
 import os, re, sys, subprocess, shutil, tempfile, signal
 import time, datetime
 import errno, socket
+import fcntl, struct
 import xml.dom.minidom
 import scsiutil
 import statvfs
@@ -59,8 +60,13 @@ ISCSI_REFDIR = '/var/run/sr-ref'
 
 CMD_DD = "/bin/dd"
 
+BLKZEROOUT = 0x127f # _IO(0x12, 127) from linux/fs.h
+
 FIST_PAUSE_PERIOD = 30 # seconds
 
+PLUGIN_TASK_POLL_INTERVAL = 0.1 # seconds, doubled after every poll
+PLUGIN_TASK_POLL_MAX_INTERVAL = 2 # seconds
+
 class SMException(Exception):
     """Base class for all SM exceptions for easier catching & wrapping in 
     XenError"""
@@ -603,6 +609,23 @@ def zeroOut(path, fromByte, bytes):
 
     return True
 
+def zeroRangeFast(path, fromByte, bytes):
+    """zero 'bytes' bytes of the block device 'path' starting from fromByte
+    (inclusive) with the BLKZEROOUT ioctl, which lets the device do the work
+    instead of writing zeros through the page cache. Falls back to zeroOut
+    for unaligned ranges and if the ioctl is not supported"""
+    if not (fromByte % 512 or bytes % 512):
+        try:
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", fromByte, bytes))
+                return True
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            SMlog("BLKZEROOUT on %s failed: %s, falling back to dd" % (path, e))
+    return zeroOut(path, fromByte, bytes)
+
 def match_rootdev(s):
     regex = re.compile("^PRIMARY_DISK")
     return regex.search(s, 0)
@@ -725,6 +748,71 @@ def get_all_slaves(session):
     master_ref = get_this_host_ref(session)
     return filter(lambda x: x != master_ref, host_refs)
 
+def call_plugin_async(session, host_ref, plugin, fn, args):
+    """Submit a host plugin call as an asynchronous XAPI task and return the
+    task, to be waited for with wait_plugin_tasks"""
+    return session.xenapi.Async.host.call_plugin(host_ref, plugin, fn, args)
+
+def cancel_plugin_tasks(session, pending):
+    """Cancel and destroy the tasks of the (key, task) pairs in pending,
+    ignoring errors: the tasks may have finished in the meantime"""
+    for key, task in pending:
+        try:
+            session.xenapi.task.cancel(task)
+        except Exception:
+            pass
+        try:
+            session.xenapi.task.destroy(task)
+        except Exception:
+            pass
+
+def wait_plugin_tasks(session, pending, max_left=0, should_stop=None):
+    """Wait for the (key, task) pairs in pending until no more than max_left
+    of them are still running, or until should_stop(finished) returns True.
+    The tasks are polled every PLUGIN_TASK_POLL_INTERVAL seconds at first,
+    backing off to PLUGIN_TASK_POLL_MAX_INTERVAL for slow calls. Finished
+    tasks are destroyed; if the wait is interrupted by an exception (e.g.
+    raised by should_stop) the tasks still running are cancelled.
+
+    Returns (still_pending, finished), where finished is a list of
+    (key, result, error) triples: result is the decoded return value of the
+    plugin, or None if the task did not succeed, in which case error is the
+    XenAPI.Failure (or other exception) saying why"""
+    finished = []
+    interval = PLUGIN_TASK_POLL_INTERVAL
+    try:
+        while True:
+            still_pending = []
+            for key, task in pending:
+                try:
+                    status = session.xenapi.task.get_status(task)
+                    if status == "pending":
+                        still_pending.append((key, task))
+                        continue
+                    if status == "success":
+                        result = session.xenapi.task.get_result(task)
+                        finished.append((key, xmlrpclib.loads( \
+                                "<params><param>%s</param></params>" % \
+                                result)[0][0], None))
+                    else:
+                        finished.append((key, None, XenAPI.Failure( \
+                                session.xenapi.task.get_error_info(task))))
+                except Exception as e:
+                    finished.append((key, None, e))
+                try:
+                    session.xenapi.task.destroy(task)
+                except Exception:
+                    pass
+            pending = still_pending
+            if len(pending) <= max_left or \
+                    (should_stop and should_stop(finished)):
+                return pending, finished
+            time.sleep(interval)
+            interval = min(interval * 2, PLUGIN_TASK_POLL_MAX_INTERVAL)
+    except:
+        cancel_plugin_tasks(session, pending)
+        raise
+
 def is_attached_rw(sm_config):
     for key, val in sm_config.iteritems():
         if key.startswith("host_") and val == "RW":
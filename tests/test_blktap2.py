@@ -293,6 +293,62 @@ class TestVDI(unittest.TestCase):
              mock.call('vref1', 'activating')],
             any_order=True)
 
+    def _setup_plugin_tasks(self, results):
+        session = self.mock_session
+        session.xenapi.VDI.get_by_uuid.side_effect = lambda u: 'ref-' + u
+        session.xenapi.VDI.get_sm_config.return_value = {'host_href1': 'RW'}
+        session.xenapi.Async.host.call_plugin.side_effect = \
+            lambda host, plugin, action, args: 'task-' + args['vdi_uuid']
+        session.xenapi.task.get_status.return_value = 'success'
+        session.xenapi.task.get_result.side_effect = \
+            lambda task: '<value>%s</value>' % results[task[len('task-'):]]
+
+    @mock.patch('blktap2.time.sleep', autospec=True)
+    def test_tap_pause_many(self, mock_sleep):
+        self._setup_plugin_tasks({'vdi1': 'True', 'vdi2': 'False'})
+
+        paused = blktap2.VDI.tap_pause_many(
+            self.mock_session, self.sr_uuid, ['vdi1', 'vdi2'])
+
+        self.assertEqual(['vdi1'], paused)
+        self.assertEqual(
+            2, self.mock_session.xenapi.Async.host.call_plugin.call_count)
+        self.mock_session.xenapi.VDI.remove_from_sm_config.assert_called_once_with(
+            'ref-vdi2', 'paused')
+        self.assertEqual(2, self.mock_session.xenapi.task.destroy.call_count)
+
+    @mock.patch('blktap2.PLUGIN_TASK_MAX_INFLIGHT', 1)
+    @mock.patch('blktap2.time.sleep', autospec=True)
+    def test_tap_pause_many_failfast(self, mock_sleep):
+        self._setup_plugin_tasks({'vdi1': 'False', 'vdi2': 'True'})
+
+        paused = blktap2.VDI.tap_pause_many(
+            self.mock_session, self.sr_uuid, ['vdi1', 'vdi2'])
+
+        self.assertEqual([], paused)
+        self.mock_session.xenapi.Async.host.call_plugin.assert_called_once_with(
+            'href1', blktap2.PLUGIN_TAP_PAUSE, 'pause',
+            {'sr_uuid': self.sr_uuid, 'vdi_uuid': 'vdi1', 'failfast': 'False'})
+        self.mock_session.xenapi.VDI.remove_from_sm_config.assert_called_once_with(
+            'ref-vdi1', 'paused')
+
+    @mock.patch('blktap2.PLUGIN_TASK_MAX_INFLIGHT', 1)
+    @mock.patch('blktap2.time.sleep', autospec=True)
+    def test_tap_unpause_many(self, mock_sleep):
+        self._setup_plugin_tasks({'vdi1': 'False', 'vdi2': 'True'})
+        self.mock_session.xenapi.task.get_status.side_effect = [
+            'pending', 'success', 'success']
+
+        unpaused = blktap2.VDI.tap_unpause_many(
+            self.mock_session, self.sr_uuid, ['vdi1', 'vdi2'])
+
+        self.assertEqual(['vdi2'], unpaused)
+        self.mock_session.xenapi.VDI.remove_from_sm_config.assert_called_once_with(
+            'ref-vdi2', 'paused')
+        self.assertEqual(
+            2, self.mock_session.xenapi.Async.host.call_plugin.call_count)
+        mock_sleep.assert_called_once_with(util.PLUGIN_TASK_POLL_INTERVAL)
+
 
 class TestTapCtl(unittest.TestCase):
 
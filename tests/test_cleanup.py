@@ -12,6 +12,8 @@ import util
 import xs_errors
 import os
 import stat
+import select
+import signal
 
 import ipc
 
@@ -35,11 +37,17 @@ class AlwaysLockedLock(object):
     def acquireNoblock(self):
         return False
 
+    def acquireTimeout(self, timeout):
+        return False
+
 
 class AlwaysFreeLock(object):
     def acquireNoblock(self):
         return True
 
+    def acquireTimeout(self, timeout):
+        return True
+
 
 class TestRelease(object):
     pass
@@ -190,7 +198,7 @@ class TestSR(unittest.TestCase):
 
     @mock.patch('util.fistpoint', autospec=True)
     @mock.patch('cleanup.SR', autospec=True)
-    @mock.patch('cleanup.Util.runAbortable')
+    @mock.patch('cleanup.Util.abortableSleep')
     def test_gcPause_calls_fist_point(
             self,
             mock_abortable,
@@ -218,7 +226,7 @@ class TestSR(unittest.TestCase):
 
     @mock.patch('util.fistpoint', autospec=True)
     @mock.patch('cleanup.SR', autospec=True)
-    @mock.patch('cleanup.Util.runAbortable')
+    @mock.patch('cleanup.Util.abortableSleep')
     @mock.patch('os.path.exists', autospec=True)
     def test_gcPause_calls_abortable_sleep(
             self,
@@ -242,13 +250,114 @@ class TestSR(unittest.TestCase):
         mock_fist_point.is_active.assert_called_with(util.GCPAUSE_FISTPOINT)
 
         # Fist point is not active so call abortable sleep.
-        mock_abortable.assert_called_with(mock.ANY, None, mock_sr.uuid,
-                                          mock.ANY, cleanup.VDI.POLL_INTERVAL,
-                                          cleanup.GCPAUSE_DEFAULT_SLEEP * 1.1)
+        mock_abortable.assert_called_with(cleanup.GCPAUSE_DEFAULT_SLEEP,
+                                          mock.ANY, cleanup.VDI.POLL_INTERVAL)
+
+    @mock.patch('cleanup.IPCFlag', autospec=True)
+    @mock.patch('cleanup.Util.log')
+    def test_runAbortable_reaps_child_that_reported_before_abort(
+            self, mock_log, mock_ipc_flag):
+        reported = []
+
+        def abortTest():
+            # abort only once the child's result is waiting in the pipe
+            reported.append(True)
+            if len(reported) == 1:
+                return False
+            # time.sleep is mocked out
+            select.select([], [], [], 0.5)
+            return True
+
+        with mock.patch('cleanup.os.waitpid',
+                        wraps=os.waitpid) as mock_waitpid:
+            with self.assertRaises(cleanup.AbortException):
+                cleanup.Util.runAbortable(lambda: True, True, "ns",
+                                          abortTest, 60, 0)
+
+        pid = mock_waitpid.call_args[0][0]
+        mock_waitpid.assert_called_once_with(pid, 0)
+        for call in mock_log.call_args_list:
+            self.assertNotIn("timed out", call[0][0])
+
+    @mock.patch('cleanup.time.time')
+    def test_abortableSleep(self, mock_time):
+        clock = [1000]
+        mock_time.side_effect = lambda: clock[0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+        cleanup.time.sleep.side_effect = sleep
+
+        cleanup.Util.abortableSleep(2.5, lambda: False, 1)
+        self.assertEqual(1002.5, clock[0])
+
+        aborts = iter([False, False, True])
+        with self.assertRaises(cleanup.AbortException):
+            cleanup.Util.abortableSleep(10, lambda: next(aborts), 1)
+        self.assertEqual(1004.5, clock[0])
+
+    @mock.patch('cleanup.select.select')
+    def test_waitForSignal(self, mock_select):
+        waits = []
+
+        def wait(rlist, wlist, xlist, timeout):
+            waits.append(timeout)
+            if len(waits) == 2:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            return [], [], []
+        mock_select.side_effect = wait
+        oldHandler = signal.getsignal(signal.SIGUSR1)
+
+        signum = cleanup._waitForSignal([signal.SIGUSR1, signal.SIGINT])
+
+        self.assertEqual(signal.SIGUSR1, signum)
+        self.assertEqual([cleanup.SIGNAL_WAIT_POLL_INTERVAL] * 2, waits)
+        self.assertEqual(oldHandler, signal.getsignal(signal.SIGUSR1))
+
+    @mock.patch('cleanup.select.select')
+    def test_waitForSignal_signal_before_wait(self, mock_select):
+        """
+        A signal delivered right after the handlers are installed, before
+        the wait starts, is not lost.
+        """
+        realSignal = signal.signal
+        installed = []
+
+        def installHandler(signum, handler):
+            old = realSignal(signum, handler)
+            installed.append(signum)
+            if len(installed) == 2:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            return old
+
+        with mock.patch('cleanup.signal.signal', side_effect=installHandler):
+            signum = cleanup._waitForSignal([signal.SIGUSR1, signal.SIGINT])
+
+        self.assertEqual(signal.SIGUSR1, signum)
+        self.assertFalse(mock_select.called)
+
+    @mock.patch('cleanup.select.select')
+    def test_waitForSignal_signal_before_blocking(self, mock_select):
+        """
+        A signal landing after the check but before the wait blocks only
+        delays the return by one bounded wait.
+        """
+        def wait(rlist, wlist, xlist, timeout):
+            # the signal arrived just before we blocked: the real select
+            # sleeps out its timeout and returns
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertIsNotNone(timeout)
+            return [], [], []
+        mock_select.side_effect = wait
+
+        signum = cleanup._waitForSignal([signal.SIGUSR1, signal.SIGINT])
+
+        self.assertEqual(signal.SIGUSR1, signum)
+        self.assertEqual(1, mock_select.call_count)
 
     @mock.patch('util.fistpoint', autospec=True)
     @mock.patch('cleanup.SR', autospec=True)
-    @mock.patch('cleanup.Util.runAbortable')
+    @mock.patch('cleanup.Util.abortableSleep')
     @mock.patch('os.path.exists', autospec=True)
     def test_gcPause_skipped_on_first_run(
             self,
@@ -329,17 +438,17 @@ class TestSR(unittest.TestCase):
         self.assertEquals(cleanup.lockActive.release.call_count, 0)
 
     @mock.patch('cleanup._abort')
-    @mock.patch.object(__builtin__, 'raw_input')
+    @mock.patch('cleanup._waitForSignal')
     def test_abort_optional_renable_active_held(
             self,
-            mock_raw_input,
+            mock_wait_for_signal,
             mock_abort):
         """
         Cli has option to re enable gc make sure we release the locks
         correctly if _abort returns True.
         """
         mock_abort.return_value = True
-        mock_raw_input.return_value = None
+        mock_wait_for_signal.return_value = signal.SIGUSR1
 
         self.mock_cleanup_locks()
 
@@ -352,17 +461,17 @@ class TestSR(unittest.TestCase):
         self.assertEquals(cleanup.lockRunning.release.call_count, 1)
 
     @mock.patch('cleanup._abort')
-    @mock.patch.object(__builtin__, 'raw_input')
+    @mock.patch('cleanup._waitForSignal')
     def test_abort_optional_renable_active_not_held(
             self,
-            mock_raw_input,
+            mock_wait_for_signal,
             mock_abort):
         """
         Cli has option to reenable gc make sure we release the locks
         correctly if _abort return False.
         """
         mock_abort.return_value = False
-        mock_raw_input.return_value = None
+        mock_wait_for_signal.return_value = signal.SIGUSR1
 
         self.mock_cleanup_locks()
 
@@ -747,7 +856,7 @@ class TestSR(unittest.TestCase):
         sr, good = self.srWithOneGoodVDI(mock_getConfig, goodConfig)
         bad = self.addBadVDITOSR(sr, config, coalesceable=coalesceable)
         if failed:
-            sr._failedCoalesceTargets = [bad]
+            sr._failedCoalesceTargets = set([bad])
 
         res = []
         sr.gatherLeafCoalesceable(res)
@@ -955,6 +1064,84 @@ class TestSR(unittest.TestCase):
         self.assertEqual(sr.writeSpeedToFile.call_count, 1)
         sr.writeSpeedToFile.assert_called_with(1.8)
 
+    def test_getStorageSpeedCached(self):
+        sr_uuid = uuid4()
+        xapi = mock.MagicMock(autospec=True)
+        sr = cleanup.SR(uuid=sr_uuid, xapi=xapi, createLock=False, force=False)
+        sr.writeSpeedToFile = mock.MagicMock(autospec=True)
+        sr.getStorageSpeed = mock.MagicMock(side_effect=[None, 1.8])
+
+        self.assertEqual(sr._getStorageSpeedCached(), None)
+        self.assertEqual(sr._getStorageSpeedCached(), None)
+        self.assertEqual(sr.getStorageSpeed.call_count, 1)
+
+        sr.recordStorageSpeed(1, 6, 9)
+        self.assertEqual(sr._getStorageSpeedCached(), 1.8)
+        self.assertEqual(sr.getStorageSpeed.call_count, 2)
+
+        sr.getStorageSpeed.side_effect = [2.5]
+        sr.cleanup()
+        self.assertEqual(sr._getStorageSpeedCached(), 2.5)
+
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_getStorageSpeedCached_after_coalesce_child(self,
+                                                       mock_abortable):
+        """
+        A speed sample written by the runAbortable child of a coalesce is
+        picked up by the parent
+        """
+        sr = create_cleanup_sr(self.xapi_mock)
+        vdi = cleanup.VDI(sr, str(uuid4()), False)
+        sr.getStorageSpeed = mock.MagicMock(side_effect=[None, 1.8])
+
+        self.assertEqual(sr._getStorageSpeedCached(), None)
+
+        # the child appends to the speed log: nothing happens in-process
+        vdi._coalesceVHD(0)
+
+        self.assertEqual(sr._getStorageSpeedCached(), 1.8)
+        self.assertEqual(sr.getStorageSpeed.call_count, 2)
+
+    def test_getExtraSpaceForCoalescing_cached_per_epoch(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+        vdi = cleanup.VDI(sr, str(uuid4()), False)
+        vdi._calcExtraSpaceForCoalescing = mock.MagicMock(
+            side_effect=[100, 200])
+
+        self.assertEqual(vdi._getExtraSpaceForCoalescing(), 100)
+        self.assertEqual(vdi._calcExtraSpaceForLeafCoalescing(), 100)
+        self.assertEqual(vdi._calcExtraSpaceForCoalescing.call_count, 1)
+
+        sr._scanEpoch += 1
+        self.assertEqual(vdi._getExtraSpaceForCoalescing(), 200)
+        self.assertEqual(vdi._calcExtraSpaceForCoalescing.call_count, 2)
+
+    @mock.patch('cleanup.Util.logException')
+    @mock.patch('cleanup.vhdutil', autospec=True)
+    def test_increaseSizeVirt_keeps_original_error(self, mock_vhdutil,
+                                                    mock_log_exc):
+        sr = create_cleanup_sr(self.xapi_mock)
+        vdi = cleanup.VDI(sr, str(uuid4()), False)
+        vdi.path = "/dev/null"
+        vdi.sizeVirt = 1
+        mock_vhdutil.getMaxResizeSize.return_value = 10
+        mock_vhdutil.setSizeVirtFast.side_effect = \
+            util.CommandException(1, "resize")
+        mock_vhdutil.getSizeVirt.side_effect = \
+            util.CommandException(2, "query")
+
+        with self.assertRaises(util.CommandException) as cm:
+            vdi._increaseSizeVirt(2 * 1024 * 1024)
+
+        self.assertEqual(1, cm.exception.code)
+        self.assertEqual(1, mock_log_exc.call_count)
+
+        mock_vhdutil.getSizeVirt.side_effect = None
+        mock_vhdutil.getSizeVirt.return_value = 3
+        with self.assertRaises(util.CommandException):
+            vdi._increaseSizeVirt(2 * 1024 * 1024)
+        self.assertEqual(3, vdi.sizeVirt)
+
     def makeFakeFile(self):
         FakeFile.writelines = mock.MagicMock()
         FakeFile.write = mock.MagicMock()
@@ -1354,6 +1541,17 @@ class TestSR(unittest.TestCase):
         self.autopsyTracker(tracker, res, expectedHistory,
                             expectedReason, 100, 121, 100)
 
+    def test_leafCoalesceTracker_grace_for_progress(self):
+        tracker = cleanup.SR.CoalesceTracker()
+        size = 100000
+        # every iteration shrinks the VHD by 10%: 5 extra iterations granted
+        for x in range(15):
+            self.assertFalse(tracker.abortCoalesce(size, size * 9 / 10))
+            size = size * 9 / 10
+        self.assertEqual(5, tracker.graceIts)
+        self.assertTrue(tracker.abortCoalesce(size, size * 9 / 10))
+        self.assertEqual("Max iterations (15) exceeded", tracker.reason)
+
     def runAbortable(self, func, ret, ns, abortTest, pollInterval, timeOut):
         return func()
 
@@ -1397,15 +1595,15 @@ class TestSR(unittest.TestCase):
 
         mock_abortable.side_effect = self.runAbortable
 
-        sr_uuid = uuid4()
-        sr = create_cleanup_sr(self.xapi_mock, uuid=str(sr_uuid))
-        sr.journaler = mock_journaler
-
         mock_ipc_flag = mock.MagicMock(spec=ipc.IPCFlag)
         print('IPC = %s' % (mock_ipc_flag))
         self.mock_IPCFlag.return_value = mock_ipc_flag
         mock_ipc_flag.test.return_value = None
 
+        sr_uuid = uuid4()
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(sr_uuid))
+        sr.journaler = mock_journaler
+
         vdis = self.add_vdis_for_coalesce(sr)
         mock_journaler.get.return_value = None
 
@@ -1505,3 +1703,309 @@ class TestSR(unittest.TestCase):
         self.assertIn('Failed to tag vdi', sme.exception.message)
 
         self.assertGreater(mock_sleep.call_count, 5)
+
+    def test_countBits_equal_length(self):
+        self.assertEqual(0, cleanup.Util.countBits("\x00\x00", "\x00\x00"))
+        self.assertEqual(9, cleanup.Util.countBits("\xff\x01", "\x0f\x00"))
+        self.assertEqual(16, cleanup.Util.countBits("\xf0\x0f", "\x0f\xf0"))
+
+    def test_countBits_different_length(self):
+        self.assertEqual(10, cleanup.Util.countBits("\x01", "\x01\xff\x01"))
+        self.assertEqual(10, cleanup.Util.countBits("\x01\xff\x01", "\x01"))
+        self.assertEqual(3, cleanup.Util.countBits("", "\x07"))
+        self.assertEqual(0, cleanup.Util.countBits("", ""))
+
+    def test_tree_walks(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.Mock()
+        sr.journaler.get.return_value = None
+
+        vdis = self.add_vdis_for_coalesce(sr)
+        sibling = cleanup.VDI(sr, str(uuid4()), False)
+        sibling.parent = vdis['vdi']
+        vdis['vdi'].children.append(sibling)
+        sr.vdis[sibling.uuid] = sibling
+        vdis['child'].parent = vdis['vdi']
+        for vdi in sr.vdis.values():
+            vdi.scanError = False
+
+        self.assertEqual(3, vdis['parent'].getTreeHeight())
+        self.assertEqual(2, vdis['vdi'].getTreeHeight())
+        self.assertEqual(vdis['parent'], sibling.getTreeRoot())
+        self.assertEqual(vdis['parent'], vdis['child'].getTreeRoot())
+        self.assertEqual(vdis['parent'], vdis['parent'].getTreeRoot())
+        self.assertEqual([vdis['child'], sibling],
+                         vdis['parent'].getAllLeaves())
+        self.assertEqual([], vdis['parent'].getAllPrunable())
+
+        vdis['child'].hidden = True
+        sibling.hidden = True
+        vdis['vdi'].hidden = True
+        self.assertEqual([vdis['child'], sibling, vdis['vdi'], vdis['parent']],
+                         vdis['parent'].getAllPrunable())
+
+        # the cached height is only reused until the tree changes
+        vdis['vdi'].children.remove(sibling)
+        vdis['child'].children.append(sibling)
+        sr._scanEpoch += 1
+        self.assertEqual(4, vdis['parent'].getTreeHeight())
+        self.assertEqual([sibling], vdis['parent'].getAllLeaves())
+
+        vdis['vdi'].parent = None
+        vdis['parent'].children.remove(vdis['vdi'])
+        sr._scanEpoch += 1
+        self.assertEqual(vdis['vdi'], sibling.getTreeRoot())
+
+    @mock.patch('cleanup.vhdutil.setHidden', autospec=True)
+    def test_findGarbage_skips_clean_trees(self, mock_setHidden):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.Mock()
+        sr.journaler.get.return_value = None
+
+        vdis = self.add_vdis_for_coalesce(sr)
+        vdis['child'].parent = vdis['vdi']
+        for vdi in sr.vdis.values():
+            vdi.scanError = False
+            vdi.hidden = False
+        sr.vdiTrees = [vdis['parent']]
+        sr._dirtyRoots = set(sr.vdiTrees)
+
+        self.assertEqual([], sr.findGarbage())
+        self.assertEqual(set(), sr._dirtyRoots)
+
+        vdis['child']._setHidden(True)
+        self.assertEqual(set([vdis['parent']]), sr._dirtyRoots)
+        self.assertEqual([vdis['child'], vdis['vdi'], vdis['parent']],
+                         sr.findGarbage())
+
+    def test_hasCoalesceable_uses_upper_bound_first(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.Mock()
+        sr.journaler.getAll.return_value = {}
+        sr.getSwitch = mock.Mock(return_value=None)
+        sr.getFreeSpace = mock.Mock(return_value=100)
+        sr.findCoalesceable = mock.Mock(return_value=None)
+        vdi = mock.Mock()
+        vdi._calcMaxExtraSpaceForCoalescing.return_value = 10
+        sr._categorize = mock.Mock(return_value=([vdi], [], []))
+
+        self.assertTrue(sr._hasCoalesceable())
+        self.assertEqual(0, sr.findCoalesceable.call_count)
+
+        # the worst case does not fit: fall back to the exact calculation
+        vdi._calcMaxExtraSpaceForCoalescing.return_value = 1000
+        self.assertFalse(sr._hasCoalesceable())
+        self.assertEqual(1, sr.findCoalesceable.call_count)
+
+        # nothing to coalesce at all
+        sr._categorize.return_value = ([], [], [])
+        self.assertFalse(sr._hasCoalesceable())
+        self.assertEqual(1, sr.findCoalesceable.call_count)
+
+    def test_findCoalesceable_prefers_tallest_tree_that_fits(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.Mock()
+        sr.journaler.getAll.return_value = {}
+        sr.getFreeSpace = mock.Mock(return_value=100)
+        self.xapi_mock.srRecord = {"other_config": {}}
+
+        def candidate(height, space):
+            vdi = mock.Mock()
+            vdi.getTreeRoot.return_value.getTreeHeight.return_value = height
+            vdi._getExtraSpaceForCoalescing.return_value = space
+            return vdi
+
+        low = candidate(2, 0)
+        tall_big = candidate(5, 1000)
+        tall = candidate(5, 10)
+        tall_late = candidate(5, 10)
+        sr._categorize = mock.Mock(
+            return_value=([low, tall_big, tall, tall_late], [], []))
+
+        self.assertEqual(tall, sr.findCoalesceable())
+        self.assertEqual(0, low._getExtraSpaceForCoalescing.call_count)
+        self.assertEqual(0, tall_late._getExtraSpaceForCoalescing.call_count)
+
+    @mock.patch('cleanup.SR.getInstance')
+    def test_get_coalesceable_leaves(self, mock_getInstance):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        mock_getInstance.return_value = sr
+        sr.scanLocked = mock.Mock()
+        vdis = self.add_vdis_for_coalesce(sr)
+        vdis['child'].parent = vdis['vdi']
+        for vdi in sr.vdis.values():
+            vdi.scanError = False
+        uuids = [vdis['child'].uuid, vdis['vdi'].uuid]
+
+        self.assertEqual({vdis['vdi'].uuid: vdis['vdi']},
+                         sr.getVDIs([vdis['vdi'].uuid, str(uuid4())]))
+        self.assertEqual([vdis['child'].uuid],
+                         cleanup.get_coalesceable_leaves(None, sr.uuid, uuids))
+        with self.assertRaises(util.SMException):
+            cleanup.get_coalesceable_leaves(None, sr.uuid,
+                                            uuids + [str(uuid4())])
+
+    @mock.patch('cleanup.SR.getInstance')
+    def test_should_preempt(self, mock_getInstance):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        mock_getInstance.return_value = sr
+        sr.scanLocked = mock.Mock()
+        sr.journaler = mock.Mock()
+        sr.journaler.get.return_value = None
+        vdis = self.add_vdis_for_coalesce(sr)
+        vdis['child'].parent = vdis['vdi']
+        for vdi in sr.vdis.values():
+            vdi.scanError = False
+            vdi.hidden = False
+        sr.vdiTrees = [vdis['parent']]
+
+        sr.journaler.getAll.return_value = {}
+        self.assertFalse(cleanup.should_preempt(None, sr.uuid))
+
+        sr.journaler.getAll.return_value = {vdis['vdi'].uuid: "1"}
+        self.assertFalse(cleanup.should_preempt(None, sr.uuid))
+
+        # the leaf went away: everything below the root is garbage now
+        vdis['child'].hidden = True
+        sr.journaler.getAll.return_value = {vdis['vdi'].uuid: "1"}
+        self.assertTrue(cleanup.should_preempt(None, sr.uuid))
+
+        sr.journaler.getAll.return_value = {str(uuid4()): "1"}
+        self.assertFalse(cleanup.should_preempt(None, sr.uuid))
+
+    def test_leafCoalesceRecovered(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr.journaler = mock.Mock()
+        vdi = mock.Mock()
+        sr.vdis = {"a": vdi}
+        calls = mock.Mock()
+        calls.attach_mock(sr.journaler.removeMany, "removeMany")
+        calls.attach_mock(vdi.ensureUnpaused, "ensureUnpaused")
+
+        sr._leafCoalesceRecovered([])
+        self.assertEqual([], calls.mock_calls)
+
+        sr._leafCoalesceRecovered(["a", "b"])
+        self.assertEqual([mock.call.removeMany(cleanup.VDI.JRN_LEAF,
+                                               ["a", "b"]),
+                          mock.call.ensureUnpaused()], calls.mock_calls)
+
+    @mock.patch('cleanup.time.time')
+    def test_scanLocked_maxAge(self, mock_time):
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr.lock = mock.Mock()
+        sr.unlock = mock.Mock()
+
+        def scan(force=False):
+            sr._scanEpoch += 1
+        sr.scan = mock.Mock(side_effect=scan)
+        mock_time.return_value = 1000
+
+        sr.scanLocked(maxAge=1)
+        sr.scanLocked(maxAge=1)
+        self.assertEqual(1, sr.scan.call_count)
+
+        # without maxAge, or once the tree changed, always rescan
+        sr.scanLocked()
+        self.assertEqual(2, sr.scan.call_count)
+        sr._scanEpoch += 1
+        sr.scanLocked(maxAge=1)
+        self.assertEqual(3, sr.scan.call_count)
+
+        mock_time.return_value = 1001
+        sr.scanLocked(maxAge=1)
+        self.assertEqual(4, sr.scan.call_count)
+
+    @mock.patch('cleanup.random.random', return_value=0.5)
+    def test_scanRetrySleep(self, mock_random):
+        sr = create_cleanup_sr(self.xapi_mock)
+
+        for attempt in range(sr.SCAN_RETRY_ATTEMPTS):
+            sr._scanRetrySleep(attempt)
+
+        # no sleep after the last attempt
+        self.assertEqual([mock.call(sr.SCAN_RETRY_BASE_SLEEP * 2 ** i)
+                          for i in range(sr.SCAN_RETRY_ATTEMPTS - 1)],
+                         cleanup.time.sleep.call_args_list)
+
+    @mock.patch('cleanup.XAPI.__init__', return_value=None)
+    def test_callPluginOnHosts(self, mock_init):
+        xapi = cleanup.XAPI(None, None)
+        xapi.session = mock.Mock()
+        xapi.xenapi = xapi.session.xenapi
+        xapi.xenapi.Async.host.call_plugin.side_effect = \
+            lambda host, plugin, fn, args: "task-" + host
+        statuses = {"task-h1": ["pending", "success"],
+                    "task-h2": ["failure"]}
+        xapi.xenapi.task.get_status.side_effect = \
+            lambda task: statuses[task].pop(0)
+        xapi.xenapi.task.get_result.return_value = \
+            "<value>True</value>"
+        xapi.xenapi.task.get_error_info.return_value = ["ERR"]
+
+        results, failures = xapi.callPluginOnHosts(["h1", "h2"],
+                "on-slave", "multi", {})
+
+        self.assertEqual({"h1": "True"}, results)
+        self.assertEqual(["h2"], failures.keys())
+        self.assertEqual(2, xapi.xenapi.Async.host.call_plugin.call_count)
+        self.assertEqual(2, xapi.xenapi.task.destroy.call_count)
+
+    @mock.patch('cleanup.XAPI.__init__', return_value=None)
+    def test_callPluginOnHosts_abort(self, mock_init):
+        xapi = cleanup.XAPI(None, None)
+        xapi.session = mock.Mock()
+        xapi.xenapi = xapi.session.xenapi
+        xapi.xenapi.Async.host.call_plugin.return_value = "task"
+        xapi.xenapi.task.get_status.return_value = "pending"
+        abortFlag = mock.Mock()
+        abortFlag.test.return_value = True
+
+        with self.assertRaises(cleanup.AbortException):
+            xapi.callPluginOnHosts(["h1"], "on-slave", "multi", {}, abortFlag)
+
+        xapi.xenapi.task.cancel.assert_called_once_with("task")
+
+    @mock.patch('cleanup.time.time')
+    @mock.patch('cleanup.XAPI.__init__', return_value=None)
+    def test_getRecordHost_cached(self, mock_init, mock_time):
+        xapi = cleanup.XAPI(None, None)
+        xapi._hostRecords = (None, {})
+        xapi.xenapi = mock.Mock()
+        xapi.xenapi.host.get_all_records.return_value = \
+            {"h1": {"hostname": "one"}}
+        xapi.xenapi.host.get_record.return_value = {"hostname": "two"}
+        mock_time.return_value = 1000
+
+        self.assertEqual("one", xapi.getRecordHost("h1")["hostname"])
+        self.assertEqual("one", xapi.getRecordHost("h1")["hostname"])
+        self.assertEqual("two", xapi.getRecordHost("h2")["hostname"])
+        self.assertEqual(1, xapi.xenapi.host.get_all_records.call_count)
+
+        mock_time.return_value = 1000 + cleanup.XAPI.HOST_RECORDS_TTL
+        xapi.getRecordHost("h1")
+        self.assertEqual(2, xapi.xenapi.host.get_all_records.call_count)
+
+    @mock.patch('cleanup.Util.log')
+    def test_logf(self, mock_log):
+        arg = mock.Mock()
+        arg.__str__ = mock.Mock(return_value="vdi")
+
+        with mock.patch('cleanup.util.LOGGING', False):
+            cleanup.Util.logf("Deleting %s", arg)
+        self.assertEqual(0, mock_log.call_count)
+        self.assertEqual(0, arg.__str__.call_count)
+
+        with mock.patch('cleanup.util.LOGGING', True):
+            cleanup.Util.logf("Deleting %s", arg)
+        mock_log.assert_called_once_with("Deleting vdi")
+
+    def test_num2str(self):
+        self.assertEqual("-1", cleanup.Util.num2str(-1))
+        self.assertEqual("0", cleanup.Util.num2str(0))
+        self.assertEqual("1023", cleanup.Util.num2str(1023))
+        self.assertEqual("1.000K", cleanup.Util.num2str(1024))
+        self.assertEqual("1023.999K", cleanup.Util.num2str(1024 * 1024 - 1))
+        self.assertEqual("1.500M", cleanup.Util.num2str(1536 * 1024))
+        self.assertEqual("2.000G", cleanup.Util.num2str(2 * 1024 ** 3))
+        self.assertEqual("4096.000G", cleanup.Util.num2str(4 * 1024 ** 4))
@@ -4,6 +4,7 @@ import mock
 import os
 import gc
 import errno
+import signal
 import struct
 
 import testlib
@@ -192,6 +193,81 @@ class TestLock(unittest.TestCase):
 
         self.assertFalse(lck1.held())
 
+    @testlib.with_context
+    def test_lock_acquire_timeout_release(self, context):
+        self.setup_fcntl_return(context)
+
+        lck = lock.Lock("somename")
+
+        self.assertTrue(lck.acquireTimeout(1))
+
+        self.assertTrue(lck.held())
+
+        lck.release()
+
+        self.assertFalse(lck.held())
+
+    def fcntl_interrupted_by(self, signum):
+        def interrupted(*args):
+            os.kill(os.getpid(), signum)
+            raise IOError(errno.EINTR, "Interrupted")
+        return interrupted
+
+    @testlib.with_context
+    def test_lock_acquire_timeout_expires(self, context):
+        self.setup_fcntl_return(context)
+        context.mock_fcntl.side_effect = \
+            self.fcntl_interrupted_by(signal.SIGALRM)
+
+        lck = lock.Lock("somename")
+
+        self.assertFalse(lck.acquireTimeout(1))
+
+        self.assertFalse(lck.held())
+
+    @testlib.with_context
+    def test_lock_acquire_timeout_retries_other_signals(self, context):
+        self.setup_fcntl_return(context)
+        packed = context.mock_fcntl.return_value
+        interrupted = self.fcntl_interrupted_by(signal.SIGUSR1)
+        calls = []
+
+        def fcntl_side_effect(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                interrupted()
+            return packed
+        context.mock_fcntl.side_effect = fcntl_side_effect
+        oldHandler = signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+        self.addCleanup(signal.signal, signal.SIGUSR1, oldHandler)
+
+        lck = lock.Lock("somename")
+
+        self.assertTrue(lck.acquireTimeout(1))
+        self.assertTrue(lck.held())
+        self.assertEqual(2, len(calls))
+        lck.release()
+
+    @testlib.with_context
+    def test_lock_acquire_timeout_restores_timer(self, context):
+        self.setup_fcntl_return(context)
+
+        def handler(signum, frame):
+            pass
+        oldHandler = signal.signal(signal.SIGALRM, handler)
+        self.addCleanup(signal.signal, signal.SIGALRM, oldHandler)
+        signal.setitimer(signal.ITIMER_REAL, 100)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+
+        lck = lock.Lock("somename")
+
+        self.assertTrue(lck.acquireTimeout(1))
+        lck.release()
+
+        self.assertIs(handler, signal.getsignal(signal.SIGALRM))
+        delay, interval = signal.getitimer(signal.ITIMER_REAL)
+        self.assertTrue(99 < delay <= 100)
+
 
 def create_lock_class_that_fails_to_create_file(number_of_failures):
 
@@ -26,52 +26,38 @@ class TestCreate(unittest.TestCase):
         self.addCleanup(lock_patcher.stop)
         self.mock_lock = lock_patcher.start()
 
-    @with_lvm_subsystem
-    def test_create_volume_size(self, lvsystem):
+    def create_volume(self, lvsystem):
         lvsystem.add_volume_group('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
 
         lvutil.create('volume', 100 * ONE_MEGABYTE, 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
 
         created_lv, = lvsystem.get_logical_volumes_with_name('volume')
-
-        self.assertEquals(100, created_lv.size_mb)
+        return created_lv
 
     @with_lvm_subsystem
-    def test_create_volume_is_in_the_right_volume_group(self, lvsystem):
-        lvsystem.add_volume_group('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
-
-        lvutil.create('volume', 100 * ONE_MEGABYTE, 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
+    def test_create_volume_size(self, lvsystem):
+        created_lv = self.create_volume(lvsystem)
 
-        created_lv, = lvsystem.get_logical_volumes_with_name('volume')
+        self.assertEqual(100, created_lv.size_mb)
 
-        self.assertEquals(100, created_lv.size_mb)
+    @with_lvm_subsystem
+    def test_create_volume_is_in_the_right_volume_group(self, lvsystem):
+        created_lv = self.create_volume(lvsystem)
 
-        self.assertEquals('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7', created_lv.volume_group.name)
+        self.assertEqual('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7', created_lv.volume_group.name)
         self.assertTrue(created_lv.active)
         self.assertTrue(created_lv.zeroed)
 
     @with_lvm_subsystem
     def test_create_volume_is_active(self, lvsystem):
-        lvsystem.add_volume_group('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
-
-        lvutil.create('volume', 100 * ONE_MEGABYTE, 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
-
-        created_lv, = lvsystem.get_logical_volumes_with_name('volume')
-
-        self.assertEquals(100, created_lv.size_mb)
+        created_lv = self.create_volume(lvsystem)
 
         self.assertTrue(created_lv.active)
         self.assertTrue(created_lv.zeroed)
 
     @with_lvm_subsystem
     def test_create_volume_is_zeroed(self, lvsystem):
-        lvsystem.add_volume_group('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
-
-        lvutil.create('volume', 100 * ONE_MEGABYTE, 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7')
-
-        created_lv, = lvsystem.get_logical_volumes_with_name('volume')
-
-        self.assertEquals(100, created_lv.size_mb)
+        created_lv = self.create_volume(lvsystem)
 
         self.assertTrue(created_lv.zeroed)
 
@@ -82,7 +68,7 @@ class TestCreate(unittest.TestCase):
         lvutil.create('volume', ONE_MEGABYTE, 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7', tag='hello')
 
         created_lv, = lvsystem.get_logical_volumes_with_name('volume')
-        self.assertEquals('hello', created_lv.tag)
+        self.assertEqual('hello', created_lv.tag)
 
     @mock.patch('util.pread', autospec=True)
     def test_create_percentage_has_precedence_over_size(self, mock_pread):
@@ -105,7 +91,7 @@ class TestRemove(unittest.TestCase):
 
         lvutil.remove('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume')
 
-        self.assertEquals([], lvsystem.get_logical_volumes_with_name('volume'))
+        self.assertEqual([], lvsystem.get_logical_volumes_with_name('volume'))
 
     @mock.patch('lvutil._lvmBugCleanup', autospec=True)
     @mock.patch('util.pread', autospec=True)
@@ -92,3 +92,34 @@ class TestCreate(unittest.TestCase):
             mock_log.assert_called_with(expectedMsg)
             mock_remove.assert_called_with("/var/run/random_temp.txt")
             self.assertEqual(opener_mock.return_value.close.call_count, 1)
+
+    @mock.patch('util.time.sleep', autospec=True)
+    def test_wait_plugin_tasks_backs_off(self, mock_sleep):
+        session = mock.Mock()
+        statuses = ["pending"] * 7 + ["success"]
+        session.xenapi.task.get_status.side_effect = \
+            lambda task: statuses.pop(0)
+        session.xenapi.task.get_result.return_value = "<value>True</value>"
+
+        pending, finished = util.wait_plugin_tasks(session, [("k", "task")])
+
+        self.assertEqual([], pending)
+        self.assertEqual([("k", "True", None)], finished)
+        self.assertEqual([0.1, 0.2, 0.4, 0.8, 1.6, 2, 2],
+                         [c[0][0] for c in mock_sleep.call_args_list])
+        session.xenapi.task.destroy.assert_called_once_with("task")
+
+    @mock.patch('util.time.sleep', autospec=True)
+    def test_wait_plugin_tasks_cancels_on_exception(self, mock_sleep):
+        session = mock.Mock()
+        session.xenapi.task.get_status.return_value = "pending"
+
+        def should_stop(finished):
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            util.wait_plugin_tasks(session, [("k", "task")],
+                                   should_stop=should_stop)
+
+        session.xenapi.task.cancel.assert_called_once_with("task")
+        session.xenapi.task.destroy.assert_called_once_with("task")